@@ -0,0 +1,212 @@
+import copy
+import json
+import numpy as np
+import torch
+import torch.nn as nn
+from abc import ABC, abstractmethod
+from ThermalClassifier.transforms.prepare_to_models import Model2Transforms
+from ThermalClassifier.models.resnet import resnet18
+
+METADATA_KEY = 'thermal_classifier_metadata'
+# architectures of the slim checkpoints, by model_name
+eager_models = {'resnet18': resnet18}
+
+
+class FeaturesAndLogits(nn.Module):
+    """
+    Exportable view of a classification model, always returns (logits, features).
+    """
+    def __init__(self, model: nn.Module) -> None:
+        super().__init__()
+        self.model = model
+
+    def forward(self, x):
+        return self.model(x, get_features=True)
+
+
+class UInt8Input(nn.Module):
+    """
+    Inference view of a classification model that takes uint8 [B, H, W, C] crops instead of normalized float ones.
+    The to_tensor scaling and the normalization run in graph as a single fused op, or with fold=True are folded into
+    the first conv of the model. Folding is exact except on the first conv zero padding, where the padded zeros now stand
+    for black pixels instead of the mean, so the outputs on the crop borders are slightly different.
+    """
+    def __init__(self, model: nn.Module, mean, std, fold: bool = False) -> None:
+        super().__init__()
+        scale = 1 / (255 * torch.as_tensor(std, dtype=torch.float32))
+        shift = -torch.as_tensor(mean, dtype=torch.float32) / torch.as_tensor(std, dtype=torch.float32)
+        self.fold = fold
+        self.model = copy.deepcopy(model)
+
+        if fold:
+            self.fold_into_first_conv(scale, shift)
+        else:
+            self.register_buffer('scale', scale.view(1, -1, 1, 1))
+            self.register_buffer('shift', shift.view(1, -1, 1, 1))
+
+    @torch.no_grad()
+    def fold_into_first_conv(self, scale, shift):
+        conv = next(module for module in self.model.modules() if isinstance(module, nn.Conv2d))
+        bias = conv.bias if conv.bias is not None else torch.zeros(conv.out_channels)
+        new_bias = bias + (conv.weight * shift.view(1, -1, 1, 1)).sum(dim=(1, 2, 3))
+        conv.weight.mul_(scale.view(1, -1, 1, 1))
+        conv.bias = nn.Parameter(new_bias)
+
+    def forward(self, x, get_features=False):
+        # the permuted NHWC input is already in channels_last memory format
+        x = x.permute(0, 3, 1, 2).float()
+        if not self.fold:
+            x = torch.addcmul(self.shift, x, self.scale)
+        return self.model(x, get_features)
+
+
+def create_metadata(model_name, model_transforms, idx2class):
+    return {'model_name': model_name,
+            'model_transforms': {'name': type(model_transforms).__name__, 'args': model_transforms.get_config()},
+            'idx2class': {str(idx): class_name for idx, class_name in idx2class.items()}}
+
+
+def export_onnx(lightning_model, output_path, opset_version: int = 17):
+    import onnx
+
+    wrapper = FeaturesAndLogits(lightning_model.model).eval()
+    model_transforms = lightning_model.model_transforms
+    dummy = torch.zeros(1, model_transforms.in_channels, *model_transforms.resize_shape)
+    torch.onnx.export(wrapper, dummy, str(output_path), input_names=['images'], output_names=['logits', 'features'],
+                      dynamic_axes={'images': {0: 'batch'}, 'logits': {0: 'batch'}, 'features': {0: 'batch'}},
+                      opset_version=opset_version)
+
+    # bundle the preprocessing config and classes inside the onnx file
+    metadata = create_metadata(lightning_model.model_name, lightning_model.model_transforms, lightning_model.idx2class)
+    onnx_model = onnx.load(str(output_path))
+    onnx.helper.set_model_props(onnx_model, {METADATA_KEY: json.dumps(metadata)})
+    onnx.save(onnx_model, str(output_path))
+
+
+def export_torchscript(lightning_model, output_path, module: nn.Module = None):
+    """
+    module: An already converted version of FeaturesAndLogits(lightning_model.model) (e.g. int8 quantized) to export instead.
+    """
+    module = FeaturesAndLogits(lightning_model.model).eval() if module is None else module
+    model_transforms = lightning_model.model_transforms
+    dummy = torch.zeros(1, model_transforms.in_channels, *model_transforms.resize_shape)
+    with torch.no_grad():
+        traced = torch.jit.trace(module, dummy)
+
+    metadata = create_metadata(lightning_model.model_name, lightning_model.model_transforms, lightning_model.idx2class)
+    torch.jit.save(traced, str(output_path), _extra_files={METADATA_KEY: json.dumps(metadata)})
+
+
+def export_slim(lightning_model, output_path):
+    # only the weights, transforms config and classes, no hyperparameters, optimizer state or lightning objects
+    torch.save({'metadata': create_metadata(lightning_model.model_name, lightning_model.model_transforms,
+                                            lightning_model.idx2class),
+                'model_kwargs': dict(lightning_model.model_kwargs),
+                'state_dict': lightning_model.model.state_dict()}, str(output_path))
+
+
+class ExportedModel(ABC):
+    """
+    Common interface of the exported models, the parts of BboxMultiClassClassifier that Predictor uses.
+    """
+    def __init__(self, metadata: dict) -> None:
+        self.model_name = metadata['model_name']
+        transforms_config = metadata['model_transforms']
+        self.model_transforms = Model2Transforms.registry[self.model_name](**transforms_config['args'])
+        self.idx2class = {int(idx): class_name for idx, class_name in metadata['idx2class'].items()}
+        self.class2idx = {class_name: idx for idx, class_name in self.idx2class.items()}
+
+    def to(self, device):
+        return self
+
+    def eval(self):
+        return self
+
+    @abstractmethod
+    def forward(self, batch):
+        # returns (logits, features)
+        pass
+
+    def predict_step(self, batch, transformed=True, get_features=False):
+        if not transformed:
+            batch = self.model_transforms(batch)
+
+        logits, features = self.forward(batch)
+        return logits, (features if get_features else None)
+
+
+class TorchScriptModel(ExportedModel):
+    def __init__(self, f, device='cpu') -> None:
+        extra_files = {METADATA_KEY: ''}
+        self.module = torch.jit.load(f, map_location=device, _extra_files=extra_files)
+        self.module.eval()
+        super().__init__(json.loads(extra_files[METADATA_KEY]))
+
+    def to(self, device):
+        self.module = self.module.to(device)
+        return self
+
+    def forward(self, batch):
+        return self.module(batch)
+
+
+class SlimModel(ExportedModel):
+    """
+    Eager model of a slim checkpoint created by export_slim, loads without the training stack.
+    """
+    def __init__(self, f, device='cpu') -> None:
+        checkpoint = torch.load(f, map_location='cpu', weights_only=True)
+        super().__init__(checkpoint['metadata'])
+        self.model = eager_models[self.model_name](num_target_classes=len(self.idx2class), **checkpoint['model_kwargs'])
+        self.model.load_state_dict(checkpoint['state_dict'])
+        self.model = self.model.to(device).eval()
+
+    def to(self, device):
+        self.model = self.model.to(device)
+        return self
+
+    def forward(self, batch):
+        return self.model(batch, get_features=True)
+
+    def predict_step(self, batch, transformed=True, get_features=False):
+        if not transformed:
+            batch = self.model_transforms(batch)
+        return self.model(batch, get_features)
+
+
+class OnnxRuntimeModel(ExportedModel):
+    """
+    Runs an exported onnx model with ONNX Runtime on CPU, num_threads sets the intra op threads (None = ORT default).
+    """
+    def __init__(self, f, num_threads: int = None) -> None:
+        import onnxruntime as ort
+
+        session_options = ort.SessionOptions()
+        if num_threads is not None:
+            session_options.intra_op_num_threads = num_threads
+        session_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+
+        if hasattr(f, 'read'):
+            model_bytes = f.read()
+        else:
+            with open(f, 'rb') as model_file:
+                model_bytes = model_file.read()
+        self.session = ort.InferenceSession(model_bytes, sess_options=session_options,
+                                            providers=['CPUExecutionProvider'])
+        metadata = self.session.get_modelmeta().custom_metadata_map[METADATA_KEY]
+        super().__init__(json.loads(metadata))
+
+    def forward(self, batch):
+        images = np.ascontiguousarray(batch.detach().cpu().numpy(), dtype=np.float32)
+        logits, features = self.session.run(['logits', 'features'], {'images': images})
+        return torch.from_numpy(logits), torch.from_numpy(features)
+
+
+def load_exported_model(f, model_format, device='cpu', num_threads=None):
+    if model_format == 'onnx':
+        return OnnxRuntimeModel(f, num_threads)
+    if model_format == 'torchscript':
+        return TorchScriptModel(f, device)
+    if model_format == 'slim':
+        return SlimModel(f, device)
+    raise ValueError(f'Unsupported model format {model_format}')
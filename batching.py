@@ -0,0 +1,136 @@
+import time
+import torch
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, List, Union
+from SoiUtils.interfaces import Classifier
+from ThermalClassifier.transforms.batch_transforms import bboxes_to_voc
+
+
+@dataclass
+class FrameResult:
+    frame_id: Any
+    preds: List[str]
+    probs: torch.Tensor
+    features: Union[torch.Tensor, None] = None
+
+
+@dataclass
+class _PendingFrame:
+    frame_id: Any
+    num_crops: int
+    submit_time: float
+    logits: list = field(default_factory=list)
+    features: list = field(default_factory=list)
+    done: int = 0
+    cache_lookup: Any = None
+    # the model the crops of the frame were prepared for
+    model: Any = None
+
+
+class FrameMicroBatcher(Classifier):
+    """
+    Collects the crops of several frames into batches of batch_size crops for a single forward pass.
+    submit / classify return the results of the frames that were completed, always in submission order.
+    Pending crops are flushed when batch_size is reached or when the oldest pending frame waited more than max_latency
+    (checked on submit and poll). batch_size=None runs every frame on its own, as Predictor.predict_frame_bboxes.
+    A frame is prepared, classified and translated by the model that was current on its submit, a model swapped in by
+    Predictor.update serves only the following frames and a batch never mixes two models.
+    """
+    def __init__(self, predictor, batch_size: int = 64, max_latency: float = 0.05, bboxes_format: str = 'coco',
+                 get_features: bool = True) -> None:
+        self.predictor = predictor
+        self.batch_size = batch_size
+        self.max_latency = max_latency
+        self.bboxes_format = bboxes_format
+        self.get_features = get_features
+
+        self.frames = deque()
+        self.crops = deque()
+        self.num_pending_crops = 0
+
+    def submit(self, frame_id, frame, frame_related_bboxes, track_ids=None, frame_index: int = None):
+        # frame_index: the frame number in the video, see TemporalResultCache.lookup
+        bboxes_format = self.bboxes_format
+        cache_lookup = None
+        # with a temporal cache only the bboxes without a reusable result are queued
+        if self.predictor.temporal_cache is not None:
+            voc_bboxes = bboxes_to_voc(frame_related_bboxes, bboxes_format, self.predictor.get_frame_size(frame))
+            cache_lookup = self.predictor.temporal_cache.lookup(voc_bboxes, track_ids, require_features=self.get_features,
+                                                                frame_index=frame_index)
+            frame_related_bboxes, bboxes_format = voc_bboxes[cache_lookup.missed], 'voc'
+
+        num_crops = len(frame_related_bboxes)
+        model = self.predictor.acquire_model()
+        pending_frame = _PendingFrame(frame_id, num_crops, time.perf_counter(), cache_lookup=cache_lookup, model=model)
+        self.frames.append(pending_frame)
+
+        if num_crops > 0:
+            crops = self.predictor.prepare_crops(frame, frame_related_bboxes, bboxes_format, model)
+            self.crops.append((pending_frame, crops))
+            self.num_pending_crops += num_crops
+
+        if self.batch_size is None or self.deadline_passed():
+            return self.flush()
+
+        while self.num_pending_crops >= self.batch_size:
+            self.run_batch(self.batch_size)
+        return self.pop_completed()
+
+    def classify(self, frame_id, frame, frame_related_bboxes, track_ids=None, frame_index: int = None):
+        return self.submit(frame_id, frame, frame_related_bboxes, track_ids, frame_index)
+
+    def deadline_passed(self):
+        return len(self.frames) > 0 and time.perf_counter() - self.frames[0].submit_time >= self.max_latency
+
+    def poll(self):
+        return self.flush() if self.deadline_passed() else []
+
+    def flush(self):
+        while self.num_pending_crops > 0:
+            self.run_batch(self.num_pending_crops if self.batch_size is None else min(self.batch_size, self.num_pending_crops))
+        return self.pop_completed()
+
+    def run_batch(self, batch_size):
+        # take up to batch_size crops of the same model from the head of the queue, a frame may be split between two batches
+        batch, owners = [], []
+        remaining = batch_size
+        model = self.crops[0][0].model
+        while remaining > 0 and len(self.crops) > 0 and self.crops[0][0].model is model:
+            pending_frame, crops = self.crops[0]
+            taken = crops[:remaining]
+            if len(taken) == len(crops):
+                self.crops.popleft()
+            else:
+                self.crops[0] = (pending_frame, crops[remaining:])
+            batch.append(taken)
+            owners.append((pending_frame, len(taken)))
+            remaining -= len(taken)
+        self.num_pending_crops -= batch_size - remaining
+
+        logits, features = self.predictor.predict_crops(torch.cat(batch), get_features=self.get_features, model=model)
+        start = 0
+        for pending_frame, num_crops in owners:
+            pending_frame.logits.append(logits[start: start + num_crops])
+            if features is not None:
+                pending_frame.features.append(features[start: start + num_crops])
+            pending_frame.done += num_crops
+            start += num_crops
+
+    def pop_completed(self):
+        results = []
+        while len(self.frames) > 0 and self.frames[0].done == self.frames[0].num_crops:
+            pending_frame = self.frames.popleft()
+            preds, probs, features = [], torch.empty(0), None
+            if pending_frame.num_crops > 0:
+                logits = torch.cat(pending_frame.logits)
+                preds, probs = self.predictor.translate_logits(logits, pending_frame.model), logits.softmax(dim=1)
+                features = torch.cat(pending_frame.features) if len(pending_frame.features) > 0 else None
+
+            if pending_frame.cache_lookup is not None:
+                preds, probs, features = self.predictor.temporal_cache.update(pending_frame.cache_lookup, preds, probs, features)
+            results.append(FrameResult(pending_frame.frame_id, preds, probs, features))
+        return results
+
+    def __len__(self):
+        return len(self.frames)
@@ -0,0 +1,50 @@
+from argparse import ArgumentParser
+import json
+import subprocess
+import sys
+
+# runs in a fresh interpreter so nothing is imported or cached yet
+COLD_START = '''
+import json, sys, time
+start = time.perf_counter()
+from ThermalClassifier.predictor import Predictor
+import_time = time.perf_counter() - start
+
+ckpt_path = sys.argv[1]
+import_only = ckpt_path == ''
+load_time = first_batch_time = None
+if not import_only:
+    import torch
+    start = time.perf_counter()
+    predictor = Predictor(ckpt_path, load_from_remote=False, device='cpu')
+    load_time = time.perf_counter() - start
+    start = time.perf_counter()
+    model_transforms = predictor.model.model_transforms
+    predictor.predict_crops(torch.zeros(1, model_transforms.in_channels, *model_transforms.resize_shape))
+    first_batch_time = time.perf_counter() - start
+
+heavy_modules = ['pytorch_lightning', 'lightning', 'torchmetrics', 'gcsfs', 'ThermalClassifier.image_multiclass_trainer']
+print(json.dumps({'import_time': import_time, 'load_time': load_time, 'first_batch_time': first_batch_time,
+                  'imported_training_modules': [name for name in heavy_modules if name in sys.modules]}))
+'''
+
+
+def cold_start(ckpt_path):
+    output = subprocess.run([sys.executable, '-c', COLD_START, ckpt_path], capture_output=True, text=True, check=True)
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='import time and cold start (import, load, first batch) of Predictor')
+    parser.add_argument('--ckpt_paths', nargs='*', default=[], help='local checkpoints to compare, e.g. a .ckpt and its slim .pt')
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    for ckpt_path in [''] + args.ckpt_paths:
+        runs = [cold_start(ckpt_path) for _ in range(args.repeats)]
+        name = ckpt_path if ckpt_path else 'import only'
+        print(f'{name}: imported training modules {runs[0]["imported_training_modules"]}')
+        for key in ['import_time', 'load_time', 'first_batch_time']:
+            values = [run[key] for run in runs if run[key] is not None]
+            if values:
+                print(f'    {key}: min {min(values):.3f}s, mean {sum(values) / len(values):.3f}s')
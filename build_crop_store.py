@@ -0,0 +1,23 @@
+from argparse import ArgumentParser
+from SoiUtils.load import load_yaml
+from ThermalClassifier.data_module import GenericDataModule
+from ThermalClassifier.datasets.crop_store import build_crop_store
+
+parser = ArgumentParser()
+parser.add_argument('--config_path', type=str, required=True, help='YAML path')
+parser.add_argument('--root_data_dir', type=str, required=True, help='root data dir')
+parser.add_argument('--output_dir', type=str, required=True, help='the crop stores are written to output_dir/dataset_folder/json_name')
+parser.add_argument('--context', type=float, default=1.0, help='context added on every side of the bbox, relative to max(w, h)')
+parser.add_argument('--background_scale', type=float, default=2.0, help='side of the background crops, relative to max(w, h)')
+args = parser.parse_args()
+
+cfg = load_yaml(args.config_path)
+
+# The labels and channels are stored in the crop store, the datasets are created as in training
+data_module = GenericDataModule.from_export_config(cfg, args.root_data_dir)
+
+for dataset_name in data_module.datasets_names():
+    dataset = data_module.create_frames_dataset(dataset_name)
+    store_dir = GenericDataModule.export_dir(args.output_dir, dataset_name)
+    build_crop_store(dataset, store_dir, context=args.context, background_scale=args.background_scale)
+    print(f'{dataset_name}: {len(dataset)} crops written to {store_dir}')
@@ -0,0 +1,73 @@
+import hashlib
+import json
+import os
+import threading
+from pathlib import Path
+import fsspec
+
+
+class CheckpointCache:
+    """
+    Content addressed local cache of checkpoints stored on any fsspec filesystem.
+    Every file is stored once under blobs/<sha256 of its content>, keys/ maps a remote path and its fsspec ukey
+    (which changes when the remote file changes) to the blob, so a cached checkpoint is reused without downloading it
+    and identical checkpoints under different paths share a blob.
+    """
+    def __init__(self, cache_dir, fs: fsspec.AbstractFileSystem = None, chunk_size: int = 2 ** 22) -> None:
+        self.cache_dir = Path(cache_dir)
+        self.fs = fs if fs is not None else fsspec.filesystem('file')
+        self.chunk_size = chunk_size
+        self.lock = threading.Lock()
+        (self.cache_dir/'blobs').mkdir(parents=True, exist_ok=True)
+        (self.cache_dir/'keys').mkdir(parents=True, exist_ok=True)
+
+        self.hits = 0
+        self.misses = 0
+
+    def key_path(self, path):
+        key = json.dumps([self.fs.protocol, path, self.fs.ukey(path)], default=str)
+        return self.cache_dir/'keys'/f'{hashlib.sha256(key.encode()).hexdigest()}.json'
+
+    def blob_path(self, sha256):
+        return self.cache_dir/'blobs'/sha256
+
+    def get(self, path):
+        """
+        Returns the local path of the cached copy of path, downloading it first if needed.
+        """
+        key_path = self.key_path(path)
+        with self.lock:
+            if key_path.exists():
+                blob_path = self.blob_path(json.loads(key_path.read_text())['sha256'])
+                if blob_path.exists():
+                    self.hits += 1
+                    return str(blob_path)
+
+            self.misses += 1
+            sha256 = self.download(path)
+            self.atomic_write(key_path, json.dumps({'path': path, 'sha256': sha256}).encode())
+            return str(self.blob_path(sha256))
+
+    def download(self, path):
+        tmp_path = self.cache_dir/'blobs'/f'.{os.getpid()}.{threading.get_ident()}.tmp'
+        digest = hashlib.sha256()
+        with self.fs.open(path, 'rb') as src, open(tmp_path, 'wb') as dst:
+            while True:
+                chunk = src.read(self.chunk_size)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                dst.write(chunk)
+
+        sha256 = digest.hexdigest()
+        os.replace(tmp_path, self.blob_path(sha256))
+        return sha256
+
+    @staticmethod
+    def atomic_write(path, data: bytes):
+        tmp_path = path.with_suffix(f'.{os.getpid()}.tmp')
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, path)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
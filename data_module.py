@@ -1,15 +1,32 @@
 import pytorch_lightning as pl
+import time
+import logging
 from pathlib import Path
-from torch.utils.data import DataLoader
-from ThermalClassifier.datasets import datasets_data
-from ThermalClassifier.datasets import datasets_data
-from ThermalClassifier.transforms.prepare_to_models import Transform
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import torch.distributed as dist
+from torch.utils.data import DataLoader, DistributedSampler
+from ThermalClassifier.transforms.prepare_to_models import Transform, Model2Transforms
 from ThermalClassifier.transforms import datasets_transforms
+from ThermalClassifier.transforms.general_transforms import Resize
 from ThermalClassifier.datasets.bbox_classification_dataset import BboxClassificationDataset
+from ThermalClassifier.datasets.samplers import samplers
+from ThermalClassifier.datasets.crop_store import CropStoreDataset
+from ThermalClassifier.datasets.tagged_concat_dataset import TaggedConcatDataset
+from ThermalClassifier.datasets.shards import ShardedBboxDataset
+from ThermalClassifier.datasets.annotation_index import annotation_index_dir, compile_annotation_index, is_compiled
 
-from torch.utils.data import ConcatDataset
 from torchvision.transforms import Compose
-from SoiUtils.cloud.storage import download_folder
+from ThermalClassifier.datasets.download_dataset import download_dataset
+
+
+def create_class2idx(classes, add_background_label):
+    # the labels of training, also stored in the crop stores and the shards
+    class2idx = {name.lower(): i for i, name in enumerate(classes)}
+    if add_background_label:
+        class2idx['BACKGROUND'] = len(classes)
+    return class2idx
+
+
 class GenericDataModule(pl.LightningDataModule):
     def __init__(self, 
                 train_datasets_names: list,
@@ -24,7 +41,18 @@ class GenericDataModule(pl.LightningDataModule):
                 test_batch_size: int = 256,
                 train_num_workers: int = 8,
                 val_num_workers: int = 8,
-                test_num_workers: int = 8) -> None:
+                test_num_workers: int = 8,
+                frame_cache_mb: float = 0,
+                train_sampler: dict = None,
+                crop_first: bool = False,
+                crop_store_dir: str = None,
+                batch_augmentation: bool = False,
+                setup_num_workers: int = 8,
+                sync_num_workers: int = 16,
+                sync_fs = None,
+                sync_datasets: bool = True,
+                shards_dir: str = None,
+                shuffle_buffer: int = 1000) -> None:
 
         super().__init__()
 
@@ -37,6 +65,8 @@ class GenericDataModule(pl.LightningDataModule):
         self.additional_datasets_parameters = additional_datasets_parameters if additional_datasets_parameters is not None else {}
         self.root_dir = Path(root_dir)
         self.model_transforms = model_transforms
+        # the frames are loaded with the number of channels of the model
+        self.image_mode = model_transforms.image_mode
         self.class2idx = class2idx
 
         # dataloader params
@@ -47,54 +77,224 @@ class GenericDataModule(pl.LightningDataModule):
         self.val_num_workers = val_num_workers
         self.test_num_workers = test_num_workers
 
+        # size of the per worker decoded frames cache, can be overridden per dataset in additional_datasets_parameters
+        self.frame_cache_mb = frame_cache_mb
+        # e.g. {'name': 'frame_grouped', 'window': 64}, None keeps the regular annotations shuffling
+        self.train_sampler = train_sampler
+        # crop the PIL frames before converting them to tensors
+        self.crop_first = crop_first
+        # when given, the datasets are read from the crop stores built by build_crop_store.py
+        self.crop_store_dir = Path(crop_store_dir) if crop_store_dir is not None else None
+        # when given, the datasets are streamed from the shards written by export_shards.py
+        self.shards_dir = Path(shards_dir) if shards_dir is not None else None
+        self.shuffle_buffer = shuffle_buffer
+        # the workers only crop and resize, the model augments and normalizes the batch (see BatchAugmentation)
+        self.batch_augmentation = batch_augmentation
+        # threads that build the datasets of setup, the seconds it took per dataset are kept in datasets_load_times
+        self.setup_num_workers = setup_num_workers
+        self.datasets_load_times = {}
+        # the annotation index dir of every dataset, so the annotations files are hashed once per setup
+        self.annotation_index_dirs = {}
+        # concurrent transfers of prepare_data and the fsspec filesystem the datasets are synced from (gcs by default)
+        self.sync_num_workers = sync_num_workers
+        self.sync_fs = sync_fs
+        # syncing lists the buckets on every run, turn it off on nodes that already hold the datasets without gcs credentials
+        self.sync_datasets = sync_datasets
+
+    @classmethod
+    def from_config(cls, cfg, root_dir, class2idx, model_transforms, **kwargs):
+        # the data module of a training config, kwargs override the other params (e.g. the dataloaders ones)
+        params = dict(root_dir=root_dir,
+                      train_datasets_names=cfg['train_datasets'],
+                      val_datasets_names=cfg['val_datasets'],
+                      test_datasets_names=cfg.get('test_datasets', []),
+                      class2idx=class2idx,
+                      model_transforms=model_transforms,
+                      additional_datasets_parameters=cfg.get('additional_datasets_parameters', None),
+                      frame_cache_mb=cfg.get('frame_cache_mb', 0),
+                      train_sampler=cfg.get('train_sampler', None),
+                      crop_first=cfg.get('crop_first', False),
+                      crop_store_dir=cfg.get('crop_store_dir', None),
+                      batch_augmentation=cfg.get('batch_augmentation', False),
+                      setup_num_workers=cfg.get('setup_num_workers', 8),
+                      sync_num_workers=cfg.get('sync_num_workers', 16),
+                      sync_datasets=cfg.get('sync_datasets', True),
+                      shards_dir=cfg.get('shards_dir', None),
+                      shuffle_buffer=cfg.get('shuffle_buffer', 1000))
+        params.update(kwargs)
+        return cls(**params)
+
+    @classmethod
+    def from_export_config(cls, cfg, root_dir):
+        # the data module of a training config before there is a model, for the scripts that export its datasets
+        model_transforms = Model2Transforms.registry[cfg['model']](in_channels=cfg.get('in_channels', 3))
+        return cls.from_config(cfg, root_dir, create_class2idx(cfg['classes'], cfg['add_background_label']),
+                               model_transforms)
+
+    @staticmethod
+    def export_dir(output_dir, dataset_name):
+        # crop stores and shards of dataset_folder/file.json are written to output_dir/dataset_folder/file
+        dataset_dir, annotation_file_name = dataset_name.split("/")
+        return Path(output_dir)/dataset_dir/Path(annotation_file_name).stem
+
+    def datasets_names(self):
+        return sorted(set(self.train_datasets_names + self.val_datasets_names + self.test_datasets_names))
+
 
     def prepare_data(self):
+        if not self.sync_datasets:
+            return
         for dataset_name in self.all_datasets_names:
-            dataset_metadata =  datasets_data[dataset_name]
-            download_folder(self.root_dir, 
-                            dataset_metadata['BUCKET_NAME'], dataset_metadata['DATASET_DIR'])
+            download_dataset(self.root_dir, dataset_name, self.sync_fs, self.sync_num_workers)
     
     def setup(self, stage: str) -> None:
         
         if stage == 'fit':
-            self.train_dataset = self.get_dataset(self.train_datasets_names, deterministic=False)
-            
-            self.val_dataset = self.get_dataset(self.val_datasets_names) 
+            self.train_dataset, self.val_dataset = self.get_datasets([(self.train_datasets_names, False),
+                                                                      (self.val_datasets_names, True)])
+
+        if stage == 'validate':
+            self.val_dataset = self.get_dataset(self.val_datasets_names)
 
         if stage == 'test':
             self.test_dataset = self.get_dataset(self.test_datasets_names)
 
     def get_dataset(self, datasets_names, deterministic=True):
-        datasets_list = []
+        return self.get_datasets([(datasets_names, deterministic)])[0]
+
+    def get_datasets(self, splits: list):
+        """
+        splits: list of (datasets_names, deterministic), the member datasets of all the splits are built concurrently
+        and a TaggedConcatDataset is returned per split, in order.
+        """
+        if self.shards_dir is not None:
+            return [self.get_sharded_dataset(datasets_names, deterministic) for datasets_names, deterministic in splits]
+
+        jobs = [(dataset_name, deterministic) for datasets_names, deterministic in splits for dataset_name in datasets_names]
+        start = time.perf_counter()
+        if self.crop_store_dir is None:
+            self.compile_annotation_indexes({dataset_name for dataset_name, _ in jobs})
+        with ThreadPoolExecutor(max_workers=max(1, min(self.setup_num_workers, len(jobs)))) as pool:
+            # map keeps the jobs order
+            members = list(pool.map(lambda job: self.timed_create_dataset(*job), jobs))
+        logging.info(f'{len(jobs)} datasets loaded in {time.perf_counter() - start:.2f}s')
+
+        datasets, offset = [], 0
+        for datasets_names, _ in splits:
+            # the samples are tagged with their dataset for the per dataset metrics
+            datasets.append(TaggedConcatDataset(members[offset: offset + len(datasets_names)], datasets_names))
+            offset += len(datasets_names)
+        return datasets
+
+    def compile_annotation_indexes(self, datasets_names):
+        """
+        Parsing an annotations file holds the GIL, so the annotation indexes missing from the cache are compiled by
+        processes. The datasets are then built by threads from the memory mapped indexes.
+        """
+        missing = []
         for dataset_name in datasets_names:
-            dataset_name, annotation_file_name = dataset_name.split("/")
-            dataset_transform = datasets_transforms.get(dataset_name, datasets_transforms['SOI'])
-            transforms = Compose([dataset_transform(deterministic, self.class2idx), 
-                                  self.model_transforms])
-            
-            additional_params = self.additional_datasets_parameters.get(dataset_name,{})
-            dataset = BboxClassificationDataset(root_dir=f"{self.root_dir}/{dataset_name}",
-                                                annotation_file_name=annotation_file_name,
-                                                class2idx=self.class2idx,
-                                                transforms=transforms,**additional_params)
-            datasets_list.append(dataset)
-        return ConcatDataset(datasets_list)
+            dataset_dir, annotation_file_name = dataset_name.split("/")
+            annotation_path = self.root_dir/dataset_dir/annotation_file_name
+            # missing files are reported by the dataset
+            if not annotation_path.exists():
+                continue
+            cache_dir = self.additional_datasets_parameters.get(dataset_dir, {}).get('annotation_cache_dir')
+            index_dir = annotation_index_dir(annotation_path, cache_dir)
+            self.annotation_index_dirs[dataset_name] = index_dir
+            if not is_compiled(index_dir):
+                missing.append((annotation_path, index_dir))
+        if len(missing) == 0:
+            return
+
+        start = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=max(1, min(self.setup_num_workers, len(missing)))) as pool:
+            list(pool.map(compile_annotation_index, *zip(*missing)))
+        logging.info(f'{len(missing)} annotation indexes compiled in {time.perf_counter() - start:.2f}s')
+
+    def timed_create_dataset(self, dataset_name, deterministic):
+        start = time.perf_counter()
+        dataset = self.create_dataset(dataset_name, deterministic)
+        load_time = time.perf_counter() - start
+        self.datasets_load_times[dataset_name] = load_time
+        logging.info(f'{dataset_name}: {len(dataset)} samples loaded in {load_time:.2f}s')
+        return dataset
+
+    def get_sharded_dataset(self, datasets_names, deterministic=True):
+        sources = [(self.export_dir(self.shards_dir, dataset_name), self.create_transforms(dataset_name.split("/")[0], deterministic))
+                   for dataset_name in datasets_names]
+        # the evaluation splits are read in order, only the train split is shuffled and its length depends on the workers
+        return ShardedBboxDataset(sources, datasets_names, shuffle=not deterministic, shuffle_buffer=self.shuffle_buffer,
+                                  image_mode=self.image_mode, num_workers=self.train_num_workers)
+
+    def create_transforms(self, dataset_name, deterministic=True):
+        dataset_transform = datasets_transforms.get(dataset_name, datasets_transforms['SOI'])
+        model_transforms = Resize(self.model_transforms.resize_shape) if self.batch_augmentation else self.model_transforms
+        return Compose([dataset_transform(deterministic, self.class2idx, crop_first=self.crop_first,
+                                          augment=not self.batch_augmentation), 
+                        model_transforms])
+
+    def create_dataset(self, dataset_name, deterministic=True):
+        transforms = self.create_transforms(dataset_name.split("/")[0], deterministic)
+        
+        if self.crop_store_dir is not None:
+            store_dir = self.export_dir(self.crop_store_dir, dataset_name)
+            return CropStoreDataset(store_dir, transforms=transforms, in_channels=self.model_transforms.in_channels)
+
+        return self.create_frames_dataset(dataset_name, transforms)
+
+    def create_frames_dataset(self, dataset_name, transforms=None):
+        # the dataset read from the frames, also the source of the crop stores and the shards
+        index_dir = self.annotation_index_dirs.get(dataset_name)
+        dataset_name, annotation_file_name = dataset_name.split("/")
+        additional_params = {'frame_cache_mb': self.frame_cache_mb, 'image_mode': self.image_mode,
+                             'annotation_index_dir': index_dir,
+                             **self.additional_datasets_parameters.get(dataset_name,{})}
+        return BboxClassificationDataset(root_dir=f"{self.root_dir}/{dataset_name}",
+                                         annotation_file_name=annotation_file_name,
+                                         class2idx=self.class2idx,
+                                         transforms=transforms,**additional_params)
 
     def train_dataloader(self):
+        if self.shards_dir is not None:
+            # the sharded dataset shuffles itself
+            return DataLoader(self.train_dataset,
+                              batch_size=self.train_batch_size,
+                              num_workers=self.train_num_workers,
+                              pin_memory=True)
+
+        if self.train_sampler is not None:
+            sampler_params = self.train_sampler.copy()
+            batch_sampler = samplers[sampler_params.pop('name')](self.train_dataset, 
+                                                                 batch_size=self.train_batch_size, 
+                                                                 **sampler_params)
+            return DataLoader(self.train_dataset,
+                              batch_sampler=batch_sampler,
+                              num_workers=self.train_num_workers,
+                              pin_memory=True)
+
         return DataLoader(self.train_dataset, 
                           batch_size=self.train_batch_size, 
                           num_workers=self.train_num_workers,
                           pin_memory=True,
                           shuffle=True)
 
+    @staticmethod
+    def evaluation_sampler(dataset):
+        # with a train_sampler lightning does not inject its distributed samplers (see FrameGroupedBatchSampler)
+        if isinstance(dataset, ShardedBboxDataset) or not (dist.is_available() and dist.is_initialized()):
+            return None
+        return DistributedSampler(dataset, shuffle=False)
+
     def val_dataloader(self):
         return DataLoader(self.val_dataset, 
                           batch_size=self.val_batch_size, 
                           num_workers=self.val_num_workers,
+                          sampler=self.evaluation_sampler(self.val_dataset),
                           pin_memory=True)
     
     def test_dataloader(self):
         return DataLoader(self.test_dataset, 
                           batch_size=self.test_batch_size, 
                           num_workers=self.test_num_workers,
+                          sampler=self.evaluation_sampler(self.test_dataset),
                           pin_memory=True)
\ No newline at end of file
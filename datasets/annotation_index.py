@@ -0,0 +1,119 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import numpy as np
+from pathlib import Path
+
+ARRAYS = ['ann_ids', 'ann_image_ids', 'bboxes', 'category_ids', 'image_ids', 'file_names', 'file_name_offsets']
+
+
+class AnnotationIndex:
+    """
+    Columnar form of a COCO annotations file: the annotations (in the file order) as ann_ids, ann_image_ids,
+    bboxes [N, 4] and category_ids arrays, the images sorted by image_ids with their file names concatenated
+    in file_names (utf-8 bytes) and delimited by file_name_offsets [num_images + 1].
+    Loaded from the cache the arrays are memory mapped, so the DataLoader workers share their pages.
+    """
+    def __init__(self, arrays: dict, metadata: dict) -> None:
+        for name in ARRAYS:
+            setattr(self, name, arrays[name])
+        self.categories = metadata['categories']
+        self.info = metadata['info']
+
+    def __len__(self):
+        return len(self.ann_ids)
+
+    def get_file_name(self, image_id):
+        image_idx = np.searchsorted(self.image_ids, image_id)
+        if image_idx >= len(self.image_ids) or self.image_ids[image_idx] != image_id:
+            raise KeyError(f'image {image_id} is not in the annotations')
+        start, end = self.file_name_offsets[image_idx], self.file_name_offsets[image_idx + 1]
+        return bytes(self.file_names[start: end]).decode()
+
+    @classmethod
+    def from_json(cls, annotation_path):
+        with open(annotation_path) as f:
+            dataset = json.load(f)
+
+        annotations = dataset.get('annotations', [])
+        images = sorted(dataset.get('images', []), key=lambda image: image['id'])
+        encoded_file_names = [image['file_name'].encode() for image in images]
+
+        arrays = {'ann_ids': np.array([ann['id'] for ann in annotations], dtype=np.int64),
+                  'ann_image_ids': np.array([ann['image_id'] for ann in annotations], dtype=np.int64),
+                  'bboxes': np.array([ann['bbox'] for ann in annotations], dtype=np.float64).reshape(-1, 4),
+                  'category_ids': np.array([ann['category_id'] for ann in annotations], dtype=np.int64),
+                  'image_ids': np.array([image['id'] for image in images], dtype=np.int64),
+                  'file_names': np.frombuffer(b''.join(encoded_file_names), dtype=np.uint8),
+                  'file_name_offsets': np.cumsum([0] + [len(file_name) for file_name in encoded_file_names], dtype=np.int64)}
+        metadata = {'categories': dataset.get('categories', []), 'info': dataset.get('info', {})}
+        return cls(arrays, metadata)
+
+    def save(self, index_dir):
+        index_dir = Path(index_dir)
+        index_dir.mkdir(parents=True, exist_ok=True)
+        for name in ARRAYS:
+            np.save(index_dir/f'{name}.npy', getattr(self, name))
+        with open(index_dir/'metadata.json', 'w') as f:
+            json.dump({'categories': self.categories, 'info': self.info}, f)
+
+    @classmethod
+    def load(cls, index_dir):
+        index_dir = Path(index_dir)
+        arrays = {name: np.load(index_dir/f'{name}.npy', mmap_mode='r') for name in ARRAYS}
+        with open(index_dir/'metadata.json') as f:
+            metadata = json.load(f)
+        return cls(arrays, metadata)
+
+
+def file_sha256(path, chunk_size=2 ** 22):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def annotation_index_dir(annotation_path, cache_dir=None):
+    # cache_dir/<file stem>-<sha256 of the file>, next to the annotations file by default
+    annotation_path = Path(annotation_path)
+    cache_dir = Path(cache_dir) if cache_dir is not None else annotation_path.parent/'.annotation_cache'
+    return cache_dir/f'{annotation_path.stem}-{file_sha256(annotation_path)}'
+
+
+def is_compiled(index_dir):
+    return (Path(index_dir)/'metadata.json').exists()
+
+
+def compile_annotation_index(annotation_path, index_dir):
+    """
+    Compiles the AnnotationIndex of a COCO annotations file into index_dir (see annotation_index_dir) unless it is
+    already there and returns index_dir, without loading it (used by process pools, see
+    GenericDataModule.compile_annotation_indexes).
+    """
+    index_dir = Path(index_dir)
+    if is_compiled(index_dir):
+        return index_dir
+
+    annotation_index = AnnotationIndex.from_json(annotation_path)
+    # written aside and renamed so concurrent loaders never see a partial index
+    tmp_dir = index_dir.parent/f'.{index_dir.name}.{os.getpid()}.{threading.get_ident()}.tmp'
+    annotation_index.save(tmp_dir)
+    try:
+        os.rename(tmp_dir, index_dir)
+    except OSError:
+        # already created by another process or thread
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return index_dir
+
+
+def load_annotation_index(annotation_path, cache_dir=None, index_dir=None):
+    # the AnnotationIndex of a COCO annotations file, compiled once and memory mapped from the cache.
+    # index_dir skips hashing the file when its index dir is already known
+    index_dir = index_dir if index_dir is not None else annotation_index_dir(annotation_path, cache_dir)
+    return AnnotationIndex.load(compile_annotation_index(annotation_path, index_dir))
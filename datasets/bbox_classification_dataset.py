@@ -1,48 +1,57 @@
 from torch.utils.data import Dataset
 import torch
 from ThermalClassifier.datasets.classes import BboxSample
-from pycocotools.coco import COCO
+from ThermalClassifier.datasets.frame_cache import FrameCache
+from ThermalClassifier.datasets.annotation_index import load_annotation_index
+from ThermalClassifier.datasets.video_source import VideoFrameSource
 from pathlib import Path
+import numpy as np
 class BboxClassificationDataset(Dataset):
     def __init__(self,
                 root_dir: str,
                 class2idx: dict, 
                 annotation_file_name: str,
-                transforms = None,subsampling=3) -> None:
+                transforms = None,subsampling=3,
+                frame_cache_mb: float = 0,
+                annotation_cache_dir: str = None,
+                annotation_index_dir: str = None,
+                video_path: str = None,
+                frame_offset: int = 1,
+                image_mode: str = 'RGB') -> None:
 
         self.root_dir = Path(root_dir)
         self.transforms = transforms
         self.subsampling = subsampling
+        # 'L' for single channel models
+        self.image_mode = image_mode
+        # Every DataLoader worker gets a copy of the dataset and therefore its own cache
+        self.frame_cache = FrameCache(int(frame_cache_mb * 2 ** 20)) if frame_cache_mb > 0 else None
+        # when given (relative to root_dir) the frames are decoded from the video instead of the extracted frames files
+        self.frame_source = VideoFrameSource(self.root_dir/video_path, frame_offset,
+                                             image_mode=image_mode) if video_path is not None else None
         
         try:
-            data = COCO(self.root_dir/annotation_file_name)
+            self.annotations = load_annotation_index(self.root_dir/annotation_file_name, annotation_cache_dir,
+                                                     annotation_index_dir)
         except FileNotFoundError:
             raise Exception(f"{root_dir} does not have {annotation_file_name} !")
 
         # This is a small patch to way⌊ the soi labels are currently structured, 
         # there is need to append the img dir to the relative path in order to get the relevant frame
-        
-        if 'img_dir' in data.dataset['info']:
-            self.img_dir = data.dataset['info']['img_dir']
-        
-        else:
-            self.img_dir = None
+        self.img_dir = self.annotations.info.get('img_dir')
 
+        categories = {cat_dict['id']: cat_dict for cat_dict in self.annotations.categories}
+        self.class_mapper = self.create_class_mapper(categories, class2idx)
 
-        self.class_mapper = self.create_class_mapper(data.cats, class2idx)
+        # only anns that has wanted classes, subsampled by their position in the annotations file
+        category_ids = np.asarray(self.annotations.category_ids)
+        wanted = np.isin(category_ids, list(self.class_mapper.keys()))
+        self.ann_rows = np.flatnonzero(wanted & (np.arange(len(category_ids)) % subsampling == 0))
 
-        # only anns that has wanted classes !
-        self.anns_dict = {ann_id: ann_dict for ann_id, ann_dict in data.anns.items() 
-                                    if ann_dict['category_id'] in self.class_mapper}
-        
-        # Subsample the video using the subsampling variable
-        self.anns_dict = {ann_id: ann_dict for i,(ann_id, ann_dict) in enumerate(data.anns.items()) 
-                                    if i %  subsampling == 0}
-        
-        self.anns_ids = list(self.anns_dict.keys())
-        
-        self.imgToAnns = data.imgToAnns
-        self.imgs_dict = data.imgs
+        self.image_ids = np.asarray(self.annotations.ann_image_ids)[self.ann_rows]
+        unique_category_ids, inverse = np.unique(category_ids[self.ann_rows], return_inverse=True)
+        self.labels = np.array([self.class_mapper[category_id] for category_id in unique_category_ids.tolist()],
+                               dtype=np.int64)[inverse]
 
     def create_class_mapper(self, categories_dict, class2idx):
         old_2_new_idx_mapping = {}
@@ -62,21 +71,50 @@ class BboxClassificationDataset(Dataset):
 
 
     def __len__(self):
-        return len(self.anns_ids)
+        return len(self.ann_rows)
+
+    def get_image_id(self, idx):
+        return int(self.image_ids[idx])
+
+    def get_annotation(self, idx):
+        bbox = self.annotations.bboxes[self.ann_rows[idx]].tolist()
+        return int(self.image_ids[idx]), bbox, int(self.labels[idx])
+
+    def get_image_ids(self):
+        return self.image_ids.tolist()
+
+    def get_image_path(self, image_id):
+        image_file_name = self.annotations.get_file_name(image_id)
+        return self.root_dir/image_file_name if self.img_dir is None else self.root_dir/self.img_dir/image_file_name
+
+    def read_image(self, image_id):
+        if self.frame_source is not None:
+            return self.frame_source.get_frame(image_id)
+        return BboxSample.load_image(self.get_image_path(image_id), self.image_mode)
+
+    def load_image(self, image_id):
+        if self.frame_cache is None:
+            return self.read_image(image_id)
+
+        image = self.frame_cache.get(image_id)
+        if image is None:
+            image = self.read_image(image_id)
+            self.frame_cache.put(image_id, image)
+        return image
+
+    def frame_cache_stats(self):
+        return self.frame_cache.stats() if self.frame_cache is not None else None
+
+    def frame_source_stats(self):
+        return self.frame_source.stats() if self.frame_source is not None else None
 
     def __getitem__(self, idx):
         assert idx < len(self), OverflowError(f"{idx} is out of dataset range len == {len(self)}")
 
-        ann_id = self.anns_ids[idx]
-        
-        bbox = self.anns_dict[ann_id]['bbox']
-        label = self.class_mapper[self.anns_dict[ann_id]['category_id']]
-    
-        image_id = self.anns_dict[ann_id]['image_id']
-        image_file_name = self.imgs_dict[image_id]['file_name']
-        image_path = self.root_dir/image_file_name if self.img_dir is None else self.root_dir/self.img_dir/image_file_name 
+        image_id, bbox, label = self.get_annotation(idx)
+        image_path = self.get_image_path(image_id)
         
-        sample = BboxSample.create(image_path, bbox, label)
+        sample = BboxSample.create(image_path, bbox, label, image=self.load_image(image_id))
 
         if self.transforms is not None:
             sample = self.transforms(sample)
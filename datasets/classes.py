@@ -1,4 +1,4 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from PIL import Image
 import PIL
 from pybboxes import BoundingBox
@@ -60,12 +60,18 @@ class BboxSample():
     image: Union[np.array, torch.Tensor, Image.Image]
     bbox: Union[BoundingBox, None]
     label: Union[int, None]
-    metadata = {}
+    metadata: dict = field(default_factory=dict)
+
+    @staticmethod
+    def load_image(image_path, mode="RGB"):
+        # mode "L" loads the thermal frames as single channel images
+        return Image.open(image_path).convert(mode)
 
     @classmethod
     # Notice that the default parser is and gray scale parser
-    def create(cls, image_path, bbox, label):
-        image =  Image.open(image_path).convert("RGB")
+    def create(cls, image_path, bbox, label, image=None, mode="RGB"):
+        # an already decoded frame (e.g. from a frame cache) can be passed instead of reading image_path
+        image = cls.load_image(image_path, mode) if image is None else image
         bbox = BoundingBox.from_coco(*bbox, image_size=image.size)
  
         return cls(image, bbox, label)
\ No newline at end of file
@@ -0,0 +1,205 @@
+from torch.utils.data import Dataset
+import torch
+import numpy as np
+import math
+import random
+import logging
+from pathlib import Path
+from pybboxes import BoundingBox
+from ThermalClassifier.datasets.classes import BboxSample
+from ThermalClassifier.datasets.bbox_classification_dataset import BboxClassificationDataset
+
+CROPS_FILE_NAME = 'crops.bin'
+INDEX_FILE_NAME = 'index.npz'
+
+
+def context_region(bbox, image_size, context):
+    """
+    Returns the integer (x0, y0, x1, y1) region around a coco bbox, extended on every side
+    by context * max(w, h) and clipped to the image.
+    """
+    W, H = image_size
+    x, y, w, h = bbox
+    pad = context * max(w, h)
+    return (max(0, math.floor(x - pad)), max(0, math.floor(y - pad)),
+            min(W, math.ceil(x + w + pad)), min(H, math.ceil(y + h + pad)))
+
+
+def frames_bboxes(annotations):
+    # image_id -> [K, 4] coco bboxes of all the annotations of the frame, before any class filtering or subsampling
+    order = np.argsort(annotations.ann_image_ids, kind='stable')
+    image_ids, starts = np.unique(np.asarray(annotations.ann_image_ids)[order], return_index=True)
+    groups = np.split(order, starts[1:])
+    bboxes = np.asarray(annotations.bboxes)
+    return {int(image_id): bboxes[group] for image_id, group in zip(image_ids, groups)}
+
+
+def background_region(frame_bboxes, side, image_size, rng, attempts: int = 20):
+    """
+    Returns a random side x side (x0, y0, x1, y1) region of the image that does not overlap any of the frame bboxes,
+    None when none was found in attempts tries.
+    """
+    W, H = image_size
+    side = max(1, min(side, W, H))
+    for _ in range(attempts):
+        x0, y0 = int(rng.integers(0, W - side + 1)), int(rng.integers(0, H - side + 1))
+        x, y, w, h = frame_bboxes.T
+        if not np.any((x < x0 + side) & (x + w > x0) & (y < y0 + side) & (y + h > y0)):
+            return x0, y0, x0 + side, y0 + side
+    return None
+
+
+def build_crop_store(dataset: BboxClassificationDataset, output_dir, context: float = 1.0, background_scale: float = 2.0,
+                     seed: int = 0):
+    """
+    Writes a context padded uint8 crop around every annotation of the dataset into a single flat file
+    and an index with the crops offsets, shapes, labels, original bboxes, image ids and paddings.
+    The padding is too small for background samples, so every annotation also gets a background crop of
+    background_scale * max(w, h) on a side, sampled in its frame away from all the annotations (offset -1 when the frame
+    has no free region). Each frame is decoded once.
+    """
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    image2bboxes = frames_bboxes(dataset.annotations)
+
+    frame2indices = {}
+    for idx, image_id in enumerate(dataset.get_image_ids()):
+        frame2indices.setdefault(image_id, []).append(idx)
+
+    offsets, shapes, labels, bboxes, image_ids, regions = [], [], [], [], [], []
+    background_offsets, background_shapes = [], []
+    offset = 0
+    with open(output_dir/CROPS_FILE_NAME, 'wb') as crops_file:
+        for image_id, indices in frame2indices.items():
+            frame = np.asarray(dataset.load_image(image_id))
+            # grayscale frames are stored as [H, W, 1]
+            frame = frame[..., None] if frame.ndim == 2 else frame
+            frame_size = (frame.shape[1], frame.shape[0])
+            for idx in indices:
+                _, bbox, label = dataset.get_annotation(idx)
+                x0, y0, x1, y1 = context_region(bbox, frame_size, context)
+                crop = np.ascontiguousarray(frame[y0: y1, x0: x1])
+                crops_file.write(crop.tobytes())
+
+                offsets.append(offset)
+                shapes.append(crop.shape)
+                labels.append(label)
+                bboxes.append(bbox)
+                image_ids.append(image_id)
+                regions.append((x0, y0, x1, y1))
+                offset += crop.nbytes
+
+                region = background_region(image2bboxes[image_id], math.ceil(background_scale * max(bbox[2:])),
+                                           frame_size, rng)
+                if region is None:
+                    background_offsets.append(-1)
+                    background_shapes.append((0, 0, frame.shape[2]))
+                    continue
+                bx0, by0, bx1, by1 = region
+                background = np.ascontiguousarray(frame[by0: by1, bx0: bx1])
+                crops_file.write(background.tobytes())
+                background_offsets.append(offset)
+                background_shapes.append(background.shape)
+                offset += background.nbytes
+
+    bboxes = np.asarray(bboxes, dtype=np.float32).reshape(-1, 4)
+    regions = np.asarray(regions, dtype=np.int32).reshape(-1, 4)
+    # left, top, right, bottom context around the bbox inside the crop
+    paddings = np.stack([bboxes[:, 0] - regions[:, 0], bboxes[:, 1] - regions[:, 1],
+                         regions[:, 2] - (bboxes[:, 0] + bboxes[:, 2]), regions[:, 3] - (bboxes[:, 1] + bboxes[:, 3])], axis=1)
+
+    np.savez(output_dir/INDEX_FILE_NAME,
+             offsets=np.asarray(offsets, dtype=np.int64),
+             shapes=np.asarray(shapes, dtype=np.int32).reshape(-1, 3),
+             labels=np.asarray(labels, dtype=np.int64),
+             bboxes=bboxes,
+             image_ids=np.asarray(image_ids, dtype=np.int64),
+             regions=regions,
+             paddings=paddings,
+             background_offsets=np.asarray(background_offsets, dtype=np.int64),
+             background_shapes=np.asarray(background_shapes, dtype=np.int32).reshape(-1, 3))
+
+
+class CropStoreDataset(Dataset):
+    """
+    Serves the crops written by build_crop_store straight from the memory mapped file,
+    the bbox of every sample is relative to its padded crop so the crop transforms work inside the padding.
+    The background crop of the sample is passed in its metadata and SampleBackground switches to it, samples without one
+    borrow the background crop of a random sample.
+    """
+    def __init__(self, store_dir: str, transforms = None, in_channels: int = None) -> None:
+        self.store_dir = Path(store_dir)
+        self.transforms = transforms
+
+        try:
+            index = np.load(self.store_dir/INDEX_FILE_NAME)
+        except FileNotFoundError:
+            raise Exception(f"{store_dir} does not have a crop store, run build_crop_store.py first !")
+
+        self.offsets = index['offsets']
+        self.shapes = index['shapes']
+        self.labels = index['labels']
+        self.bboxes = index['bboxes']
+        self.image_ids = index['image_ids']
+        self.paddings = index['paddings']
+        if 'background_offsets' not in index:
+            raise Exception(f"{store_dir} has no background crops, rebuild it with build_crop_store.py !")
+        self.background_offsets = index['background_offsets']
+        self.background_shapes = index['background_shapes']
+        self.background_indices = np.flatnonzero(self.background_offsets >= 0)
+        if len(self.background_indices) < len(self.offsets):
+            logging.warning(f'{store_dir}: {len(self.offsets) - len(self.background_indices)} samples have no background '
+                            f'crop of their own')
+        if in_channels is not None and len(self.shapes) > 0 and self.shapes[0, 2] != in_channels:
+            raise Exception(f"{store_dir} holds {self.shapes[0, 2]} channels crops, rebuild it with in_channels: {in_channels} !")
+        self._crops = None
+
+    @property
+    def crops(self):
+        # opened lazily so every worker maps the file itself instead of receiving a pickled copy,
+        # copy on write mode returns writable views without copying the crops
+        if self._crops is None:
+            self._crops = np.memmap(self.store_dir/CROPS_FILE_NAME, dtype=np.uint8, mode='c')
+        return self._crops
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_crops'] = None
+        return state
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def get_image_ids(self):
+        return self.image_ids.tolist()
+
+    def read_crop(self, offset, shape):
+        h, w, c = shape
+        return self.crops[offset: offset + h * w * c].reshape(h, w, c)
+
+    def get_background(self, idx):
+        if self.background_offsets[idx] < 0:
+            if len(self.background_indices) == 0:
+                return None
+            idx = random.choice(self.background_indices)
+        return self.read_crop(self.background_offsets[idx], self.background_shapes[idx])
+
+    def __getitem__(self, idx):
+        assert idx < len(self), OverflowError(f"{idx} is out of dataset range len == {len(self)}")
+
+        h, w, c = self.shapes[idx]
+        crop = self.read_crop(self.offsets[idx], self.shapes[idx])
+
+        pad_left, pad_top, _, _ = self.paddings[idx]
+        _, _, bbox_w, bbox_h = self.bboxes[idx]
+        bbox = BoundingBox.from_coco(float(pad_left), float(pad_top), float(bbox_w), float(bbox_h), image_size=(int(w), int(h)))
+        sample = BboxSample(crop, bbox, int(self.labels[idx]))
+        background = self.get_background(idx)
+        if background is not None:
+            sample.metadata['background_image'] = background
+
+        if self.transforms is not None:
+            sample = self.transforms(sample)
+
+        return sample.image, torch.tensor(sample.label)
@@ -0,0 +1,80 @@
+import multiprocessing as mp
+from collections import OrderedDict
+from PIL import Image
+
+# indices of the shared counters
+HITS, MISSES, EVICTIONS = range(3)
+
+
+class FrameCache:
+    """
+    Size bounded (in bytes) LRU cache of decoded frames.
+    Each DataLoader worker holds its own copy of the dataset, hence its own cache. The hits, misses and evictions
+    counters are in shared memory inherited by the workers, so stats() of the main process copy counts all the workers.
+    """
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.frames = OrderedDict()
+        self.counters = mp.Array('q', 3)
+
+    def count(self, counter):
+        with self.counters.get_lock():
+            self.counters[counter] += 1
+
+    @property
+    def hits(self):
+        return self.counters[HITS]
+
+    @property
+    def misses(self):
+        return self.counters[MISSES]
+
+    @property
+    def evictions(self):
+        return self.counters[EVICTIONS]
+
+    @staticmethod
+    def frame_size(frame: Image.Image):
+        width, height = frame.size
+        return width * height * len(frame.getbands())
+
+    def get(self, key):
+        if key not in self.frames:
+            self.count(MISSES)
+            return None
+
+        self.count(HITS)
+        self.frames.move_to_end(key)
+        return self.frames[key][0]
+
+    def put(self, key, frame: Image.Image):
+        if key in self.frames:
+            return
+
+        frame_bytes = self.frame_size(frame)
+        # a frame that is larger than the whole cache is never stored
+        if frame_bytes > self.max_bytes:
+            return
+
+        while self.current_bytes + frame_bytes > self.max_bytes:
+            _, (_, evicted_bytes) = self.frames.popitem(last=False)
+            self.current_bytes -= evicted_bytes
+            self.count(EVICTIONS)
+
+        self.frames[key] = (frame, frame_bytes)
+        self.current_bytes += frame_bytes
+
+    def stats(self):
+        # frames and bytes are of the cache of this process only
+        hits, misses, evictions = self.counters[:]
+        requests = hits + misses
+        return {'hits': hits,
+                'misses': misses,
+                'evictions': evictions,
+                'hit_rate': hits / requests if requests else 0.0,
+                'frames': len(self.frames),
+                'bytes': self.current_bytes}
+
+    def __len__(self):
+        return len(self.frames)
@@ -0,0 +1,116 @@
+from torch.utils.data import Sampler, ConcatDataset
+import torch.distributed as dist
+import numpy as np
+
+
+class FrameGroupedBatchSampler(Sampler):
+    """
+    Shuffles the annotations at the frame level and packs whole frames into batches.
+    A batch is always loaded by a single DataLoader worker, so all the annotations of a frame
+    are read by the same worker and the frame is decoded once (see FrameCache).
+    Batches are closed when the next frame does not fit, hence they can be smaller than batch_size.
+
+    window: When None the frames are shuffled globally. Otherwise the frames are kept in their
+    dataset order, shuffled only within consecutive windows of `window` frames and the batches are shuffled.
+    sort_within_batch: The frames of every batch are loaded in their dataset order, with a window the worker decodes
+    short sequential runs of frames (see VideoFrameSource).
+    With DDP every rank takes every num_replicas-th batch of the same epoch order, the last batches are dropped so all
+    the ranks run the same number of batches. Lightning can not inject its DistributedSampler into a batch sampler,
+    so the trainer has to run with use_distributed_sampler=False (see main.py).
+    """
+    def __init__(self, dataset: ConcatDataset, batch_size: int, window: int = None,
+                 drop_last: bool = False, seed: int = 0, sort_within_batch: bool = False,
+                 num_replicas: int = None, rank: int = None) -> None:
+        distributed = dist.is_available() and dist.is_initialized()
+        self.num_replicas = num_replicas if num_replicas is not None else (dist.get_world_size() if distributed else 1)
+        self.rank = rank if rank is not None else (dist.get_rank() if distributed else 0)
+        self.batch_size = batch_size
+        self.window = window
+        self.sort_within_batch = sort_within_batch
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+        self.frames = self.group_by_frame(dataset)
+        # the batches of the current epoch, built once for __len__ and __iter__
+        self.batches = None
+        self.batches_epoch = None
+
+    @staticmethod
+    def group_by_frame(dataset: ConcatDataset):
+        frames = []
+        for dataset_idx, sub_dataset in enumerate(dataset.datasets):
+            offset = dataset.cumulative_sizes[dataset_idx - 1] if dataset_idx > 0 else 0
+            frame2indices = {}
+            for idx, image_id in enumerate(sub_dataset.get_image_ids()):
+                frame2indices.setdefault(image_id, []).append(offset + idx)
+            frames.extend(np.asarray(indices) for _, indices in sorted(frame2indices.items()))
+        return frames
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def frames_order(self, rng):
+        if self.window is None:
+            return rng.permutation(len(self.frames))
+
+        order = np.arange(len(self.frames))
+        for start in range(0, len(order), self.window):
+            rng.shuffle(order[start: start + self.window])
+        return order
+
+    def close_batch(self, batch):
+        # batch is a list of (frame_idx, indices), self.frames is in the datasets frames order
+        if self.sort_within_batch:
+            batch = sorted(batch, key=lambda frame: frame[0])
+        return np.concatenate([indices for _, indices in batch])
+
+    def create_batches(self):
+        rng = np.random.default_rng(self.seed + self.epoch)
+        batches, batch, batch_len = [], [], 0
+
+        for frame_idx in self.frames_order(rng):
+            indices = self.frames[frame_idx]
+            if batch_len + len(indices) > self.batch_size and batch_len > 0:
+                batches.append(self.close_batch(batch))
+                batch, batch_len = [], 0
+
+            # a frame with more annotations than batch_size is split into full batches
+            while len(indices) > self.batch_size:
+                batches.append(indices[:self.batch_size])
+                indices = indices[self.batch_size:]
+
+            batch.append((frame_idx, indices))
+            batch_len += len(indices)
+
+        if batch_len > 0 and not (self.drop_last and batch_len < self.batch_size):
+            batches.append(self.close_batch(batch))
+
+        if self.window is not None:
+            rng.shuffle(batches)
+
+        num_batches = len(batches) // self.num_replicas * self.num_replicas
+        return batches[self.rank: num_batches: self.num_replicas]
+
+    def get_batches(self):
+        if self.batches_epoch != self.epoch:
+            self.batches, self.batches_epoch = self.create_batches(), self.epoch
+        return self.batches
+
+    def __iter__(self):
+        for batch in self.get_batches():
+            yield batch.tolist()
+
+    def __len__(self):
+        return len(self.get_batches())
+
+    def locality_stats(self):
+        frames_sizes = np.array([len(indices) for indices in self.frames])
+        return {'frames': len(self.frames),
+                'annotations': int(frames_sizes.sum()),
+                'mean_annotations_per_frame': float(frames_sizes.mean()) if len(self.frames) else 0.0,
+                'split_frames': int((frames_sizes > self.batch_size).sum())}
+
+
+samplers = {
+    'frame_grouped': FrameGroupedBatchSampler
+}
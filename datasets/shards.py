@@ -0,0 +1,206 @@
+import io
+import itertools
+import json
+import tarfile
+import numpy as np
+import cv2 as cv
+import torch
+from pathlib import Path
+from PIL import Image
+from torch.utils.data import IterableDataset, get_worker_info
+from ThermalClassifier.datasets.classes import BboxSample
+from ThermalClassifier.datasets.bbox_classification_dataset import BboxClassificationDataset
+
+SHARDS_INDEX_FILE_NAME = 'shards.json'
+
+
+def encode_frame(dataset: BboxClassificationDataset, image_id):
+    # the original frame file when there is one, otherwise (video frames) the decoded frame as png
+    if dataset.frame_source is None:
+        image_path = dataset.get_image_path(image_id)
+        return image_path.read_bytes(), image_path.suffix.lstrip('.').lower()
+
+    frame = np.asarray(dataset.load_image(image_id))
+    if frame.ndim == 3:
+        frame = cv.cvtColor(frame, cv.COLOR_RGB2BGR)
+    return cv.imencode('.png', frame)[1].tobytes(), 'png'
+
+
+def add_tar_member(tar, name, data: bytes):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    tar.addfile(info, io.BytesIO(data))
+
+
+def write_shards(dataset: BboxClassificationDataset, output_dir, shard_size_mb: float = 256):
+    """
+    Packs the dataset into tar shards of about shard_size_mb. Every frame is a record of two members:
+    <image_id>.<image format> with the encoded frame and <image_id>.json with its annotations (bbox, label) after
+    the dataset classes filtering and subsampling. shards.json lists the shards and their number of annotations.
+    """
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    frame2indices = {}
+    for idx, image_id in enumerate(dataset.get_image_ids()):
+        frame2indices.setdefault(image_id, []).append(idx)
+
+    shards, tar, shard_bytes, shard_samples = [], None, 0, 0
+    def close_shard():
+        tar.close()
+        shards.append({'file': shard_path.name, 'samples': shard_samples})
+
+    for image_id, indices in frame2indices.items():
+        if tar is None:
+            shard_path = output_dir/f'shard-{len(shards):06d}.tar'
+            tar, shard_bytes, shard_samples = tarfile.open(shard_path, 'w'), 0, 0
+
+        image_bytes, image_format = encode_frame(dataset, image_id)
+        annotations = [dict(zip(['bbox', 'label'], dataset.get_annotation(idx)[1:])) for idx in indices]
+        record = {'image_id': image_id, 'image_path': str(dataset.get_image_path(image_id)), 'annotations': annotations}
+        record_bytes = json.dumps(record).encode()
+
+        add_tar_member(tar, f'{image_id:09d}.{image_format}', image_bytes)
+        add_tar_member(tar, f'{image_id:09d}.json', record_bytes)
+        shard_bytes += len(image_bytes) + len(record_bytes)
+        shard_samples += len(indices)
+
+        if shard_bytes >= shard_size_mb * 2 ** 20:
+            close_shard()
+            tar = None
+
+    if tar is not None:
+        close_shard()
+
+    with open(output_dir/SHARDS_INDEX_FILE_NAME, 'w') as f:
+        json.dump({'shards': shards, 'samples': sum(shard['samples'] for shard in shards)}, f, indent=2)
+    return shards
+
+
+def distributed_rank():
+    # (rank, world_size), (0, 1) when not distributed
+    if torch.distributed.is_available() and torch.distributed.is_initialized():
+        return torch.distributed.get_rank(), torch.distributed.get_world_size()
+    return 0, 1
+
+
+def read_records(shard_path, image_mode='RGB'):
+    # sequential read of a shard, yields (record, frame) per frame
+    image_bytes, record = None, None
+    with tarfile.open(shard_path, 'r|') as tar:
+        for member in tar:
+            data = tar.extractfile(member).read()
+            if member.name.endswith('.json'):
+                record = json.loads(data)
+            else:
+                image_bytes = data
+
+            if image_bytes is not None and record is not None:
+                yield record, Image.open(io.BytesIO(image_bytes)).convert(image_mode)
+                image_bytes, record = None, None
+
+
+class ShardedBboxDataset(IterableDataset):
+    """
+    Streams the shards written by write_shards, the samples are the same as TaggedConcatDataset of
+    BboxClassificationDataset: (image, label, source_idx).
+    The shards are split between the distributed ranks and then between the DataLoader workers of every rank, every worker
+    reads its shards sequentially in a random order and shuffles the samples in a buffer of shuffle_buffer samples.
+    The shards hold different amounts of samples, so when shuffling (training) every worker yields only as many samples
+    as the same worker of the rank with the fewest, all the ranks run the same number of batches (see worker_quota).
+    The evaluation splits are read whole. len() is the number of samples the rank yields.
+    Lightning does not call set_epoch on a dataset, the shuffling changes every epoch as every iteration
+    of the dataset (and every DataLoader worker seed) is seeded differently.
+
+    sources: list of (shards_dir, transforms), names: a name per source, image_mode: PIL mode of the decoded frames,
+    num_workers: the DataLoader workers that read the dataset, len() of a shuffled dataset depends on them.
+    """
+    def __init__(self, sources: list, names: list, shuffle: bool = True, shuffle_buffer: int = 1000, seed: int = 0,
+                 image_mode: str = 'RGB', num_workers: int = 0) -> None:
+        assert len(names) == len(sources), 'a name is required for every source'
+        self.names = list(names)
+        self.transforms = [transforms for _, transforms in sources]
+        self.shuffle = shuffle
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.image_mode = image_mode
+        self.num_workers = num_workers
+        self.epoch = 0
+        # number of iterations of this copy of the dataset, the main process one with num_workers=0
+        # or the workers ones with persistent_workers
+        self.iterations = 0
+
+        self.shards, self.num_samples = [], 0
+        for source_idx, (shards_dir, _) in enumerate(sources):
+            with open(Path(shards_dir)/SHARDS_INDEX_FILE_NAME) as f:
+                index = json.load(f)
+            self.shards.extend((source_idx, Path(shards_dir)/shard['file'], shard['samples']) for shard in index['shards'])
+            self.num_samples += index['samples']
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    @staticmethod
+    def count_samples(shards):
+        return sum(samples for _, _, samples in shards)
+
+    def slot_shards(self, rank, world_size, worker_id, num_workers):
+        # the shards of the rank are dealt to its workers
+        return self.shards[rank::world_size][worker_id::num_workers]
+
+    def worker_quota(self, world_size, worker_id, num_workers):
+        # the samples of the worker with the fewest among the workers with this id of all the ranks
+        return min(self.count_samples(self.slot_shards(rank, world_size, worker_id, num_workers))
+                   for rank in range(world_size))
+
+    def __len__(self):
+        rank, world_size = distributed_rank()
+        if not self.shuffle:
+            return self.count_samples(self.shards[rank::world_size])
+        num_workers = max(1, self.num_workers)
+        return sum(self.worker_quota(world_size, worker_id, num_workers) for worker_id in range(num_workers))
+
+    def worker_shards(self):
+        # returns the shards of the worker, the number of samples it yields and its global id
+        rank, world_size = distributed_rank()
+        worker_info = get_worker_info()
+        worker_id, num_workers = (worker_info.id, worker_info.num_workers) if worker_info is not None else (0, 1)
+        shards = self.slot_shards(rank, world_size, worker_id, num_workers)
+        quota = self.worker_quota(world_size, worker_id, num_workers) if self.shuffle else self.count_samples(shards)
+        return shards, quota, rank * num_workers + worker_id
+
+    def samples(self, shards):
+        for source_idx, shard_path, _ in shards:
+            transforms = self.transforms[source_idx]
+            for record, frame in read_records(shard_path, self.image_mode):
+                for annotation in record['annotations']:
+                    sample = BboxSample.create(record['image_path'], annotation['bbox'], annotation['label'], image=frame)
+                    if transforms is not None:
+                        sample = transforms(sample)
+                    yield sample.image, torch.tensor(sample.label), source_idx
+
+    def __iter__(self):
+        shards, quota, global_worker_id = self.worker_shards()
+        iteration = self.iterations
+        self.iterations += 1
+        if not self.shuffle:
+            yield from self.samples(shards)
+            return
+
+        # the DataLoader gives non persistent workers a new seed every epoch, otherwise the iteration changes
+        worker_info = get_worker_info()
+        worker_seed = worker_info.seed if worker_info is not None else 0
+        rng = np.random.default_rng([self.seed, self.epoch, iteration, global_worker_id, worker_seed])
+        shards = [shards[i] for i in rng.permutation(len(shards))]
+        buffer = []
+        # the samples beyond the quota are dropped, a different part of the shards every epoch
+        for sample in itertools.islice(self.samples(shards), quota):
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(sample)
+                continue
+            idx = rng.integers(len(buffer))
+            yield buffer[idx]
+            buffer[idx] = sample
+
+        rng.shuffle(buffer)
+        yield from buffer
@@ -0,0 +1,174 @@
+import base64
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import fsspec
+
+MANIFEST_FILE_NAME = '.sync_manifest.json'
+# listing fields that change when a remote file changes, by filesystem (gcs, s3, local, ...)
+VERSION_FIELDS = ['md5Hash', 'crc32c', 'generation', 'ETag', 'etag', 'mtime', 'LastModified', 'created']
+
+
+def remote_version(info: dict):
+    return {field: str(info[field]) for field in VERSION_FIELDS if field in info}
+
+
+def remote_md5(info: dict):
+    # gcs lists the base64 md5 of every (non composite) object
+    return base64.b64decode(info['md5Hash']).hex() if 'md5Hash' in info else None
+
+
+def file_md5(path, chunk_size: int = 2 ** 22):
+    digest = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class DatasetSync:
+    """
+    Mirrors remote_dir of an fsspec filesystem into local_dir with num_workers concurrent transfers.
+    local_dir/.sync_manifest.json keeps the size, remote version and md5 of every synced file, so a re-sync
+    downloads only the new and changed files. Files are downloaded to a .partial file named by their remote version,
+    an interrupted download is resumed from the partial file on the next sync.
+    Local files missing from the manifest (e.g. downloaded before it existed) are adopted instead of downloaded again
+    when their size matches, and their md5 too when the listing provides one.
+    """
+    def __init__(self, fs: fsspec.AbstractFileSystem, remote_dir: str, local_dir, num_workers: int = 16,
+                 chunk_size: int = 2 ** 22, manifest_flush_every: int = 100) -> None:
+        self.fs = fs
+        self.remote_dir = remote_dir.rstrip('/')
+        self.local_dir = Path(local_dir)
+        self.num_workers = num_workers
+        self.chunk_size = chunk_size
+        self.manifest_flush_every = manifest_flush_every
+
+        self.manifest_path = self.local_dir/MANIFEST_FILE_NAME
+        self.manifest = json.loads(self.manifest_path.read_text()) if self.manifest_path.exists() else {}
+        self.lock = threading.Lock()
+        self.completed_since_flush = 0
+        self.stats = {'files': 0, 'downloaded': 0, 'resumed': 0, 'skipped': 0, 'adopted': 0, 'bytes': 0, 'time': 0.0}
+
+    def list_remote(self):
+        files = self.fs.find(self.remote_dir, detail=True)
+        remote_prefix = self.fs._strip_protocol(self.remote_dir)
+        return {os.path.relpath(path, remote_prefix): info for path, info in files.items()
+                if info.get('type', 'file') == 'file' and not path.endswith('/')}
+
+    def is_synced(self, relative_path, info):
+        entry = self.manifest.get(relative_path)
+        local_path = self.local_dir/relative_path
+        return entry is not None and entry['size'] == info['size'] and entry['version'] == remote_version(info) \
+               and local_path.exists() and local_path.stat().st_size == info['size']
+
+    def adopt_local_copy(self, relative_path, info):
+        # a file with a manifest entry of another version was changed remotely and is never adopted
+        local_path = self.local_dir/relative_path
+        if relative_path in self.manifest or not local_path.exists() or local_path.stat().st_size != info['size']:
+            return False
+        expected_md5 = remote_md5(info)
+        md5 = file_md5(local_path, self.chunk_size) if expected_md5 is not None else None
+        if md5 != expected_md5:
+            return False
+
+        with self.lock:
+            self.manifest[relative_path] = {'size': info['size'], 'version': remote_version(info), 'md5': md5}
+            self.stats['adopted'] += 1
+            self.completed_since_flush += 1
+            if self.completed_since_flush >= self.manifest_flush_every:
+                self.save_manifest()
+        return True
+
+    def sync_file(self, relative_path, info):
+        if not self.adopt_local_copy(relative_path, info):
+            self.download(relative_path, info)
+
+    def partial_path(self, relative_path, info):
+        version_key = hashlib.sha256(json.dumps(remote_version(info), sort_keys=True).encode()).hexdigest()[:16]
+        local_path = self.local_dir/relative_path
+        return local_path.with_name(f'.{local_path.name}.{version_key}.partial')
+
+    def download(self, relative_path, info):
+        local_path = self.local_dir/relative_path
+        local_path.parent.mkdir(parents=True, exist_ok=True)
+        partial_path = self.partial_path(relative_path, info)
+
+        # partial files of older versions of the file are dropped
+        for stale_path in local_path.parent.glob(f'.{local_path.name}.*.partial'):
+            if stale_path != partial_path:
+                stale_path.unlink(missing_ok=True)
+
+        digest = hashlib.md5()
+        offset = partial_path.stat().st_size if partial_path.exists() else 0
+        if offset > info['size']:
+            partial_path.unlink()
+            offset = 0
+        if offset > 0:
+            with open(partial_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(self.chunk_size), b''):
+                    digest.update(chunk)
+
+        with self.fs.open(f'{self.remote_dir}/{relative_path}', 'rb') as src, open(partial_path, 'ab') as dst:
+            src.seek(offset)
+            for chunk in iter(lambda: src.read(self.chunk_size), b''):
+                digest.update(chunk)
+                dst.write(chunk)
+
+        size = partial_path.stat().st_size
+        md5 = digest.hexdigest()
+        expected_md5 = remote_md5(info)
+        if size != info['size'] or (expected_md5 is not None and md5 != expected_md5):
+            partial_path.unlink()
+            raise IOError(f'{relative_path} is corrupted: got {size} bytes md5 {md5}, '
+                          f'expected {info["size"]} bytes md5 {expected_md5}')
+        os.replace(partial_path, local_path)
+
+        with self.lock:
+            self.manifest[relative_path] = {'size': size, 'version': remote_version(info), 'md5': md5}
+            self.stats['downloaded'] += 1
+            self.stats['resumed'] += offset > 0
+            self.stats['bytes'] += size - offset
+            self.completed_since_flush += 1
+            if self.completed_since_flush >= self.manifest_flush_every:
+                self.save_manifest()
+
+    def save_manifest(self):
+        # called with the lock held, written aside and renamed so an interrupted sync keeps a valid manifest
+        self.local_dir.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.manifest_path.with_suffix('.tmp')
+        tmp_path.write_text(json.dumps(self.manifest))
+        os.replace(tmp_path, self.manifest_path)
+        self.completed_since_flush = 0
+
+    def sync(self):
+        start = time.perf_counter()
+        remote_files = self.list_remote()
+        to_download = {relative_path: info for relative_path, info in remote_files.items()
+                       if not self.is_synced(relative_path, info)}
+
+        self.stats['files'] = len(remote_files)
+        self.stats['skipped'] = len(remote_files) - len(to_download)
+        try:
+            with ThreadPoolExecutor(max_workers=self.num_workers) as pool:
+                # list() re-raises the first failed download
+                list(pool.map(lambda item: self.sync_file(*item), to_download.items()))
+        finally:
+            with self.lock:
+                # files deleted from the remote directory are forgotten (their local copies are kept)
+                self.manifest = {relative_path: entry for relative_path, entry in self.manifest.items()
+                                 if relative_path in remote_files}
+                self.save_manifest()
+
+        self.stats['time'] = time.perf_counter() - start
+        logging.info(f'synced {self.remote_dir} to {self.local_dir}: {self.stats}')
+        return self.stats
+
+
+def sync_folder(fs, remote_dir, local_dir, num_workers: int = 16):
+    return DatasetSync(fs, remote_dir, local_dir, num_workers).sync()
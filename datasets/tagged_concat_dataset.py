@@ -0,0 +1,19 @@
+import bisect
+from torch.utils.data import ConcatDataset
+
+
+class TaggedConcatDataset(ConcatDataset):
+    """
+    ConcatDataset whose samples are (image, label, source_idx), source_idx is the index of the member dataset
+    the sample came from and names[source_idx] its name (e.g. 'IRX_0003.MP4/thermal_classifier.json').
+    """
+    def __init__(self, datasets, names: list) -> None:
+        super().__init__(datasets)
+        assert len(names) == len(self.datasets), 'a name is required for every dataset'
+        self.names = list(names)
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+        source_idx = bisect.bisect_right(self.cumulative_sizes, idx)
+        return (*super().__getitem__(idx), source_idx)
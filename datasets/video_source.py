@@ -0,0 +1,112 @@
+import logging
+import numpy as np
+import cv2 as cv
+from pathlib import Path
+from PIL import Image
+
+
+def build_keyframe_index(video_path):
+    """
+    Frame numbers of the keyframes of the video, read from the packets headers with PyAV (no decoding).
+    Returns None when PyAV is not installed.
+    """
+    try:
+        import av
+    except ImportError:
+        logging.warning('PyAV is not installed, seeking without a keyframe index')
+        return None
+
+    with av.open(str(video_path)) as container:
+        stream = container.streams.video[0]
+        fps = float(stream.average_rate)
+        start_time = stream.start_time or 0
+        keyframes = [round(float((packet.pts - start_time) * stream.time_base) * fps)
+                     for packet in container.demux(stream) if packet.is_keyframe and packet.pts is not None]
+    return np.unique(np.asarray(keyframes, dtype=np.int64))
+
+
+def load_keyframe_index(video_path):
+    # built once and saved next to the video
+    index_path = Path(video_path).with_suffix('.keyframes.npy')
+    if index_path.exists():
+        return np.load(index_path)
+
+    keyframes = build_keyframe_index(video_path)
+    if keyframes is not None:
+        np.save(index_path, keyframes)
+    return keyframes
+
+
+class VideoFrameSource:
+    """
+    Serves the frames of a dataset from its source video instead of the extracted frames.
+    image_id is mapped to the frame number image_id - frame_offset (the frames of the coco files start at 1).
+    Consecutive requests are decoded sequentially. A later frame is reached by decoding forward unless a keyframe lies
+    in between (or, without a keyframe index, it is more than max_forward_frames ahead), then the video is seeked.
+    The capture is opened lazily, so every DataLoader worker has its own.
+    """
+    def __init__(self, video_path, frame_offset: int = 1, max_forward_frames: int = 30, image_mode: str = 'RGB') -> None:
+        self.video_path = Path(video_path)
+        if not self.video_path.exists():
+            raise FileNotFoundError(f'{self.video_path} does not exist')
+        self.frame_offset = frame_offset
+        self.max_forward_frames = max_forward_frames
+        self.image_mode = image_mode
+        self.keyframes = load_keyframe_index(self.video_path)
+
+        self.capture = None
+        self.next_frame = None
+        self.sequential_reads = 0
+        self.forward_reads = 0
+        self.seeks = 0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['capture'], state['next_frame'] = None, None
+        return state
+
+    def open(self):
+        self.capture = cv.VideoCapture(str(self.video_path))
+        if not self.capture.isOpened():
+            raise IOError(f'failed to open {self.video_path}')
+        self.next_frame = 0
+
+    def should_seek(self, frame_num):
+        if frame_num < self.next_frame:
+            return True
+        if self.keyframes is not None and len(self.keyframes) > 0:
+            # a keyframe after the current position makes the seek cheaper than decoding forward
+            keyframe = self.keyframes[np.searchsorted(self.keyframes, frame_num, side='right') - 1] \
+                       if frame_num >= self.keyframes[0] else 0
+            return keyframe > self.next_frame
+        return frame_num - self.next_frame > self.max_forward_frames
+
+    def get_frame(self, image_id):
+        frame_num = image_id - self.frame_offset
+        if self.capture is None:
+            self.open()
+
+        if frame_num == self.next_frame:
+            self.sequential_reads += 1
+        elif self.should_seek(frame_num):
+            self.capture.set(cv.CAP_PROP_POS_FRAMES, frame_num)
+            self.seeks += 1
+        else:
+            # skipped frames are only demuxed and decoded, never converted
+            for _ in range(frame_num - self.next_frame):
+                self.capture.grab()
+            self.forward_reads += 1
+
+        success, frame = self.capture.read()
+        if not success:
+            raise IOError(f'failed to read frame {frame_num} of {self.video_path}')
+        self.next_frame = frame_num + 1
+        if self.image_mode == 'L':
+            # same luma weights as PIL convert('L')
+            return Image.fromarray(cv.cvtColor(frame, cv.COLOR_BGR2GRAY))
+        return Image.fromarray(cv.cvtColor(frame, cv.COLOR_BGR2RGB))
+
+    def stats(self):
+        return {'sequential_reads': self.sequential_reads,
+                'forward_reads': self.forward_reads,
+                'seeks': self.seeks}
@@ -0,0 +1,50 @@
+from argparse import ArgumentParser
+from pathlib import Path
+import torch
+from ThermalClassifier.predictor import Predictor
+from ThermalClassifier.backends import export_onnx, export_torchscript, export_slim, load_exported_model
+
+
+def check_parity(lightning_model, exported_model, batch_size, atol):
+    model_transforms = lightning_model.model_transforms
+    batch = torch.randn(batch_size, model_transforms.in_channels, *model_transforms.resize_shape)
+    with torch.inference_mode():
+        expected_logits, expected_features = lightning_model.predict_step(batch, get_features=True)
+        logits, features = exported_model.predict_step(batch, get_features=True)
+
+    logits_diff = (expected_logits - logits).abs().max().item()
+    features_diff = (expected_features - features).abs().max().item()
+    assert logits_diff <= atol and features_diff <= atol, \
+        f'{exported_model.model_name} {type(exported_model).__name__} differs from the lightning model: ' \
+        f'logits max diff {logits_diff}, features max diff {features_diff}'
+    assert exported_model.idx2class == lightning_model.idx2class
+    assert exported_model.model_transforms.get_config() == lightning_model.model_transforms.get_config()
+    print(f'{type(exported_model).__name__} parity: logits max diff {logits_diff}, features max diff {features_diff}')
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--ckpt_path', type=str, required=True)
+    parser.add_argument('--load_from_remote', action='store_true')
+    parser.add_argument('--output_dir', type=str, default='weights')
+    parser.add_argument('--formats', nargs='+', default=['onnx', 'torchscript', 'slim'], choices=['onnx', 'torchscript', 'slim'])
+    parser.add_argument('--opset_version', type=int, default=17)
+    parser.add_argument('--parity_batch_size', type=int, default=8)
+    parser.add_argument('--atol', type=float, default=1e-4)
+    args = parser.parse_args()
+
+    lightning_model = Predictor(args.ckpt_path, args.load_from_remote, 'cpu').model
+    output_dir = Path(args.output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    name = Path(args.ckpt_path).stem
+
+    exporters = {'onnx': (lambda path: export_onnx(lightning_model, path, args.opset_version), '.onnx'),
+                 'torchscript': (lambda path: export_torchscript(lightning_model, path), '.ts'),
+                 'slim': (lambda path: export_slim(lightning_model, path), '.pt')}
+
+    for model_format in args.formats:
+        exporter, suffix = exporters[model_format]
+        output_path = output_dir/f'{name}{suffix}'
+        exporter(output_path)
+        print(f'exported {output_path}')
+        check_parity(lightning_model, load_exported_model(str(output_path), model_format), args.parity_batch_size, args.atol)
@@ -0,0 +1,22 @@
+from argparse import ArgumentParser
+from SoiUtils.load import load_yaml
+from ThermalClassifier.data_module import GenericDataModule
+from ThermalClassifier.datasets.shards import write_shards
+
+parser = ArgumentParser()
+parser.add_argument('--config_path', type=str, required=True, help='YAML path')
+parser.add_argument('--root_data_dir', type=str, required=True, help='root data dir')
+parser.add_argument('--output_dir', type=str, required=True, help='the shards are written to output_dir/dataset_folder/json_name')
+parser.add_argument('--shard_size_mb', type=float, default=256)
+args = parser.parse_args()
+
+cfg = load_yaml(args.config_path)
+
+# The labels are stored in the shards, the datasets are created as in training
+data_module = GenericDataModule.from_export_config(cfg, args.root_data_dir)
+
+for dataset_name in data_module.datasets_names():
+    dataset = data_module.create_frames_dataset(dataset_name)
+    shards_dir = GenericDataModule.export_dir(args.output_dir, dataset_name)
+    shards = write_shards(dataset, shards_dir, shard_size_mb=args.shard_size_mb)
+    print(f'{dataset_name}: {len(dataset)} samples written to {len(shards)} shards in {shards_dir}')
@@ -2,14 +2,15 @@ from typing import Any
 import pytorch_lightning as pl
 import torch.nn as nn
 import torch
-from torchmetrics import MetricCollection
-from torchmetrics.classification import MulticlassAccuracy, MulticlassPrecision, MulticlassRecall
 from ThermalClassifier.transforms.prepare_to_models import Model2Transforms
 from ThermalClassifier.models.resnet import resnet18
+from ThermalClassifier.transforms.batch_transforms import BatchAugmentation
+from ThermalClassifier.metrics import ConfusionMatrix, confusion_matrix_metrics
 
 
 class BboxMultiClassClassifier(pl.LightningModule):
-    def __init__(self, class2idx, model_name, model_kwargs={}, learning_rate = 1e-3, optimizer: str = "adam"):
+    def __init__(self, class2idx, model_name, model_kwargs={}, learning_rate = 1e-3, optimizer: str = "adam",
+                 batch_augmentation: bool = False):
         super().__init__()
         self.num_target_classes = len(class2idx)
         self.class2idx = class2idx
@@ -21,53 +22,80 @@ class BboxMultiClassClassifier(pl.LightningModule):
         self.optimizer = optimizer
         self.learning_rate = learning_rate
         self.loss = nn.CrossEntropyLoss()
+        # the dataloaders return resized crops, flips, rotation and normalization are applied on the batch
+        self.batch_augmentation = BatchAugmentation(self.model_transforms.normalize) if batch_augmentation else None
 
-        metrics = MetricCollection([
-            MulticlassAccuracy(self.num_target_classes, average=None), 
-            MulticlassPrecision(self.num_target_classes,average=None), 
-            MulticlassRecall(self.num_target_classes,average=None)
-        ])
-
+        # registered as submodules so they live on the training device, one source per dataset of the split
+        self.train_confusion_matrix = ConfusionMatrix(self.num_target_classes)
+        self.val_confusion_matrix = ConfusionMatrix(self.num_target_classes)
+        self.test_confusion_matrix = ConfusionMatrix(self.num_target_classes)
         self.metrices = {
-            'train': metrics.clone(prefix='train_'),
-            'val': metrics.clone(prefix='val_'),
-            'test': metrics.clone(prefix='test_')
-
+            'train': self.train_confusion_matrix,
+            'val': self.val_confusion_matrix,
+            'test': self.test_confusion_matrix
         }
         self.save_hyperparameters(ignore=['metrices', 'model'])
 
+    def on_after_batch_transfer(self, batch, dataloader_idx):
+        if self.batch_augmentation is None:
+            return batch
+
+        imgs, *rest = batch
+        # like the per sample transforms, every split except predict is augmented
+        imgs = self.batch_augmentation(imgs, augment=not self.trainer.predicting)
+        return (imgs, *rest)
+
     def shared_step(self, batch, batch_idx, split):
-        imgs, labels = batch
+        # TaggedConcatDataset batches also hold the source dataset of every sample
+        imgs, labels, *sources = batch
         logits, _ = self.model(imgs)
         loss = self.loss(logits, labels)
         
-        self.metrices[split](logits.detach().cpu(), labels.detach().cpu())
+        self.metrices[split].update(logits.detach(), labels, sources[0] if sources else None)
         
         return loss
 
+    def get_source_names(self, split):
+        datamodule = getattr(self.trainer, 'datamodule', None)
+        return getattr(getattr(datamodule, f'{split}_dataset', None), 'names', None)
+
+    def reset_metrices(self, split):
+        source_names = self.get_source_names(split)
+        self.metrices[split].reset(len(source_names) if source_names else 1)
+
+    def matrix_metrices(self, matrix, prefix):
+        metric_dict = {}
+        for metric_name, metric_value in confusion_matrix_metrics(matrix).items():
+            metric_dict.update({f"{class_name}_{prefix}{metric_name}": metric_value[i]
+                                for i, class_name in self.idx2class.items()})
+            metric_dict[f"{prefix}{metric_name}"] = metric_value.mean()
+        return metric_dict
+
     def log_metrices(self, split):
-        metrices = self.metrices[split].compute()
-        remaining_metrices = metrices.copy()
-        for metric_name, metric_value in metrices.items():
-            try:
-                if metric_value.shape[0] == self.num_target_classes:
-                    metric_dict = {f"{class_name}_{metric_name}": metric_value[i] 
-                     for i, class_name in enumerate(self.class2idx.keys())}
-                    metric_dict[f"{metric_name}"] = metric_value.mean()
-                    self.log_dict(metric_dict, logger=True, on_step=False, on_epoch=True)
-                    remaining_metrices.pop(metric_name)
-
-                else:
-                    continue
-            except:
-                continue             
-        if len(remaining_metrices) != 0:
-            self.log_dict(remaining_metrices, logger=True, on_step=False, on_epoch=True)
+        # sum over the devices and a single transfer per epoch
+        matrices = self.trainer.strategy.reduce(self.metrices[split].matrix, reduce_op='sum').cpu()
+        metric_dict = self.matrix_metrices(matrices.sum(dim=0), f'{split}_')
+
+        source_names = self.get_source_names(split)
+        if source_names and len(source_names) > 1:
+            for source_name, matrix in zip(source_names, matrices):
+                metric_dict.update(self.matrix_metrices(matrix, f'{source_name}_{split}_'))
+
+        self.log_dict(metric_dict, logger=True, on_step=False, on_epoch=True)
         # remember to reset metrics at the end of the epoch
         self.metrices[split].reset()
 
 
     
+    def on_train_epoch_start(self) -> None:
+        self.reset_metrices('train')
+
+    def on_validation_epoch_start(self) -> None:
+        self.reset_metrices('val')
+
+    def on_test_epoch_start(self) -> None:
+        self.reset_metrices('test')
+
     def training_step(self, batch, batch_idx):
         loss = self.shared_step(batch, batch_idx, 'train')
         self.log('train_loss', loss.detach(), on_step=False, on_epoch=True, logger=True)
@@ -0,0 +1,279 @@
+import asyncio
+import base64
+import io
+import json
+import time
+import logging
+import numpy as np
+import torch
+from PIL import Image
+from concurrent.futures import ThreadPoolExecutor
+from ThermalClassifier.batching import FrameResult
+
+
+class AsyncInferenceService:
+    """
+    asyncio front end for a Predictor shared by many concurrent callers.
+    Requests of concurrent `await classify(frame, bboxes)` calls are merged into batches of up to max_batch_size crops
+    (or whatever arrived within max_queue_delay seconds, a single request may exceed it), the batch runs on a worker thread and every caller gets
+    its own FrameResult. At most max_queue_size requests wait in the queue, further callers wait for a free slot.
+    The predictor's temporal cache is never used, the requests come from different streams.
+    On stop every request that was not answered yet (queued, collected or in the running batch) fails.
+    """
+    def __init__(self, predictor, max_batch_size: int = 64, max_queue_delay: float = 0.01, max_queue_size: int = 256,
+                 bboxes_format: str = 'coco', get_features: bool = False) -> None:
+        self.predictor = predictor
+        self.max_batch_size = max_batch_size
+        self.max_queue_delay = max_queue_delay
+        self.max_queue_size = max_queue_size
+        self.bboxes_format = bboxes_format
+        self.get_features = get_features
+
+        self.queue = None
+        self.executor = None
+        self.batching_task = None
+        self.stopped = False
+        # a request that did not fit in the collected batch, it opens the next one
+        self.held_request = None
+
+        self.batches = 0
+        self.requests = 0
+        self.crops = 0
+        self.queue_delay = 0.0
+
+    async def start(self):
+        self.queue = asyncio.Queue(self.max_queue_size)
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.batching_task = asyncio.get_running_loop().create_task(self.batching_loop())
+
+    async def stop(self):
+        self.stopped = True
+        self.batching_task.cancel()
+        try:
+            await self.batching_task
+        except asyncio.CancelledError:
+            pass
+
+        if self.held_request is not None:
+            self.fail([self.held_request[2]], self.stopped_error())
+            self.held_request = None
+        while not self.queue.empty():
+            _, _, future, _ = self.queue.get_nowait()
+            self.fail([future], self.stopped_error())
+        # waits for a running batch off the event loop, its callers already failed
+        await asyncio.to_thread(self.executor.shutdown, wait=True)
+
+    @staticmethod
+    def stopped_error():
+        return RuntimeError('the inference service is stopped')
+
+    @staticmethod
+    def fail(futures, error):
+        for future in futures:
+            if not future.done():
+                future.set_exception(error)
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *args):
+        await self.stop()
+
+    async def classify(self, frame, frame_related_bboxes):
+        if self.stopped:
+            raise self.stopped_error()
+        future = asyncio.get_running_loop().create_future()
+        # blocks while the queue is full
+        await self.queue.put((frame, np.asarray(frame_related_bboxes), future, time.perf_counter()))
+        if self.stopped:
+            # stopped while waiting for a free slot, the queue is not served anymore
+            future.cancel()
+            raise self.stopped_error()
+        return await future
+
+    async def collect_batch(self, requests: list):
+        # appends to requests, so the requests collected so far are known when the loop is cancelled
+        loop = asyncio.get_running_loop()
+        if self.held_request is not None:
+            requests.append(self.held_request)
+            self.held_request = None
+        else:
+            requests.append(await self.queue.get())
+        num_crops = self.num_crops(requests[0])
+        deadline = loop.time() + self.max_queue_delay
+
+        while num_crops < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                request = await asyncio.wait_for(self.queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            if num_crops + self.num_crops(request) > self.max_batch_size:
+                self.held_request = request
+                break
+            requests.append(request)
+            num_crops += self.num_crops(request)
+
+    @staticmethod
+    def num_crops(request):
+        # malformed bboxes count as a single crop, they fail their request in run_batch
+        bboxes = request[1]
+        return len(bboxes) if bboxes.ndim > 0 else 1
+
+    def run_batch(self, requests):
+        """
+        Returns a FrameResult or the raised exception per request. The crops are prepared per request, so a bad request
+        fails only its own caller, and all of them are classified in a single forward by the same model.
+        """
+        model = self.predictor.acquire_model()
+        outcomes, crops = [], []
+        for frame, frame_related_bboxes, _, _ in requests:
+            try:
+                request_crops = self.predictor.prepare_crops(frame, frame_related_bboxes, self.bboxes_format, model)
+            except Exception as e:
+                outcomes.append(e)
+                continue
+            outcomes.append(len(request_crops))
+            crops.append(request_crops)
+
+        logits, features = torch.empty(0), None
+        if sum(len(request_crops) for request_crops in crops) > 0:
+            logits, features = self.predictor.predict_crops(torch.cat(crops), get_features=self.get_features, model=model)
+
+        results, start = [], 0
+        for request_idx, outcome in enumerate(outcomes):
+            if isinstance(outcome, Exception):
+                results.append(outcome)
+                continue
+            request_logits = logits[start: start + outcome]
+            results.append(FrameResult(request_idx, self.predictor.translate_logits(request_logits, model),
+                                       request_logits.softmax(dim=1),
+                                       features[start: start + outcome] if features is not None else None))
+            start += outcome
+        return results
+
+    async def batching_loop(self):
+        loop = asyncio.get_running_loop()
+        requests = []
+        try:
+            while True:
+                requests = []
+                await self.collect_batch(requests)
+                start = time.perf_counter()
+                self.queue_delay += sum(start - submit_time for _, _, _, submit_time in requests)
+                futures = [future for _, _, future, _ in requests]
+
+                try:
+                    results = await loop.run_in_executor(self.executor, self.run_batch, requests)
+                except Exception as e:
+                    self.fail(futures, e)
+                    continue
+
+                for future, result in zip(futures, results):
+                    if future.done():
+                        continue
+                    if isinstance(result, Exception):
+                        future.set_exception(result)
+                    else:
+                        future.set_result(result)
+
+                self.batches += 1
+                self.requests += len(requests)
+                self.crops += sum(len(result.preds) for result in results if not isinstance(result, Exception))
+        except asyncio.CancelledError:
+            # the requests being collected or classified when the service stops
+            self.fail([future for _, _, future, _ in requests], self.stopped_error())
+            raise
+
+    def stats(self):
+        return {'batches': self.batches,
+                'requests': self.requests,
+                'mean_requests_per_batch': self.requests / self.batches if self.batches else 0.0,
+                'mean_crops_per_batch': self.crops / self.batches if self.batches else 0.0,
+                'mean_queue_delay': self.queue_delay / self.requests if self.requests else 0.0,
+                'queued': self.queue.qsize() if self.queue is not None else 0}
+
+
+async def handle_http_request(service: AsyncInferenceService, reader, writer):
+    """
+    Minimal local HTTP stand-in: POST /classify with a json body {"image": <base64 encoded image>, "bboxes": [[...], ...]}
+    returns {"preds": [...], "probs": [[...], ...]}.
+    """
+    try:
+        request_line = (await reader.readline()).decode()
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode().strip()
+            if not line:
+                break
+            key, value = line.split(':', 1)
+            headers[key.strip().lower()] = value.strip()
+
+        method, path, _ = request_line.split(' ', 2)
+        if method != 'POST' or path != '/classify':
+            status, body = '404 Not Found', {'error': f'{method} {path} is not supported'}
+        else:
+            request = json.loads(await reader.readexactly(int(headers.get('content-length', 0))))
+            frame = Image.open(io.BytesIO(base64.b64decode(request['image']))).convert('RGB')
+            result = await service.classify(frame, request['bboxes'])
+            status, body = '200 OK', {'preds': result.preds, 'probs': result.probs.tolist()}
+    except Exception as e:
+        logging.exception('failed to handle request')
+        status, body = '400 Bad Request', {'error': str(e)}
+
+    payload = json.dumps(body).encode()
+    writer.write(f'HTTP/1.1 {status}\r\nContent-Type: application/json\r\nContent-Length: {len(payload)}\r\n'
+                 f'Connection: close\r\n\r\n'.encode() + payload)
+    await writer.drain()
+    writer.close()
+
+
+async def serve_http(service: AsyncInferenceService, host: str = '127.0.0.1', port: int = 8080):
+    server = await asyncio.start_server(lambda reader, writer: handle_http_request(service, reader, writer), host, port)
+    async with server:
+        await server.serve_forever()
+
+
+class InferenceClient:
+    """
+    Client of serve_http, runs in the same process and event loop as the service for local tests:
+        server = asyncio.create_task(serve_http(service, port=8080))
+        result = await InferenceClient(port=8080).classify(frame, bboxes)
+    Returns {"preds": [...], "probs": [[...], ...]}, an error response raises.
+    """
+    def __init__(self, host: str = '127.0.0.1', port: int = 8080) -> None:
+        self.host = host
+        self.port = port
+
+    async def classify(self, frame, frame_related_bboxes):
+        frame = frame if isinstance(frame, Image.Image) else Image.fromarray(np.asarray(frame))
+        image = io.BytesIO()
+        frame.save(image, format='PNG')
+        body = json.dumps({'image': base64.b64encode(image.getvalue()).decode(),
+                           'bboxes': np.asarray(frame_related_bboxes).tolist()}).encode()
+
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        try:
+            writer.write(f'POST /classify HTTP/1.1\r\nHost: {self.host}\r\nContent-Type: application/json\r\n'
+                         f'Content-Length: {len(body)}\r\n\r\n'.encode() + body)
+            await writer.drain()
+
+            status = int((await reader.readline()).decode().split(' ')[1])
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode().strip()
+                if not line:
+                    break
+                key, value = line.split(':', 1)
+                headers[key.strip().lower()] = value.strip()
+            response = json.loads(await reader.readexactly(int(headers.get('content-length', 0))))
+        finally:
+            writer.close()
+            await writer.wait_closed()
+
+        if status != 200:
+            raise RuntimeError(f'classify failed with {status}: {response.get("error")}')
+        return response
@@ -1,6 +1,6 @@
 import pytorch_lightning as pl
 from pytorch_lightning.callbacks import ModelCheckpoint
-from ThermalClassifier.data_module import GenericDataModule
+from ThermalClassifier.data_module import GenericDataModule, create_class2idx
 from lightning.pytorch.loggers import WandbLogger
 from ThermalClassifier.image_multiclass_trainer import BboxMultiClassClassifier
 from SoiUtils.load import load_yaml
@@ -31,21 +31,16 @@ if args.updates:
         print('Invalid JSON-like syntax. Please provide updates in the correct format.')
 
 
-new_class2index = {name.lower(): i for i, name in enumerate(cfg['classes'])}
+new_class2index = create_class2idx(cfg['classes'], cfg['add_background_label'])
 
 if cfg['add_background_label']:
-    new_class2index['BACKGROUND'] = len(cfg['classes'])
     cfg['classes'].append('BACKGROUND')
 ###
-model = BboxMultiClassClassifier(class2idx=new_class2index, model_name=cfg['model'])
+model = BboxMultiClassClassifier(class2idx=new_class2index, model_name=cfg['model'],
+                                 model_kwargs={'in_channels': cfg.get('in_channels', 3)},
+                                 batch_augmentation=cfg.get('batch_augmentation', False))
 
-data_module = GenericDataModule(root_dir=cfg['root_data_dir'],
-                                train_datasets_names=cfg['train_datasets'],
-                                val_datasets_names=cfg['val_datasets'],
-                                test_datasets_names=cfg['test_datasets'],
-                                class2idx=new_class2index,
-                                model_transforms=model.get_model_transforms(),
-                                additional_datasets_parameters = cfg.get('additional_datasets_parameters',None))
+data_module = GenericDataModule.from_config(cfg, cfg['root_data_dir'], new_class2index, model.get_model_transforms())
 
 checkpoint_callback = ModelCheckpoint(dirpath=f"gcs://soi-models/VMD-classifier/{cfg['exp_name']}/checkpoints",
                                       monitor='val_MulticlassAccuracy',
@@ -61,6 +56,8 @@ trainer = pl.Trainer(default_root_dir=osp.join(cfg['gcp_dir_name'], cfg['exp_nam
                     devices=cfg['devices'],
                     callbacks=callbacks,
                     logger=wandb_logger,
+                    # the train_sampler batch samplers split the batches between the ranks themselves
+                    use_distributed_sampler=cfg.get('train_sampler', None) is None,
                     max_epochs=cfg['epochs'])
 
 trainer.fit(model, datamodule=data_module)
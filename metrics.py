@@ -0,0 +1,45 @@
+import torch
+import torch.nn as nn
+
+
+class ConfusionMatrix(nn.Module):
+    """
+    [num_sources, num_classes, num_classes] (labels x preds) counts accumulated on the model device,
+    so the metrics need a single transfer per epoch instead of one per step.
+    """
+    def __init__(self, num_classes: int, num_sources: int = 1) -> None:
+        super().__init__()
+        self.num_classes = num_classes
+        self.register_buffer('matrix', torch.zeros(num_sources, num_classes, num_classes, dtype=torch.long), persistent=False)
+
+    @property
+    def num_sources(self):
+        return self.matrix.shape[0]
+
+    @torch.no_grad()
+    def update(self, logits, labels, sources=None):
+        preds = logits.argmax(dim=1)
+        sources = torch.zeros_like(labels) if sources is None else sources
+        indices = (sources * self.num_classes + labels) * self.num_classes + preds
+        # bincount reads the indices range back to the host on cuda, index_add_ accumulates without a sync
+        indices = indices.view(-1).to(torch.long)
+        self.matrix.view(-1).index_add_(0, indices, torch.ones_like(indices))
+
+    def reset(self, num_sources: int = None):
+        num_sources = self.num_sources if num_sources is None else num_sources
+        self.matrix = torch.zeros(num_sources, self.num_classes, self.num_classes, dtype=torch.long, device=self.matrix.device)
+
+
+def confusion_matrix_metrics(matrix: torch.Tensor):
+    """
+    Per class metrics of a [num_classes, num_classes] confusion matrix, named and computed as the torchmetrics
+    Multiclass metrics with average=None (classes without samples or predictions get 0).
+    """
+    matrix = matrix.double()
+    true_positives = matrix.diagonal()
+    support, predicted = matrix.sum(dim=1), matrix.sum(dim=0)
+    recall = torch.where(support > 0, true_positives / support.clamp(min=1), torch.zeros_like(support))
+    precision = torch.where(predicted > 0, true_positives / predicted.clamp(min=1), torch.zeros_like(predicted))
+    return {'MulticlassAccuracy': recall.float(),
+            'MulticlassPrecision': precision.float(),
+            'MulticlassRecall': recall.float()}
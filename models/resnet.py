@@ -3,18 +3,26 @@ import torch.nn as nn
 from ThermalClassifier.transforms.prepare_to_models import Model2Transforms
 
 class resnet18(nn.Module):
-    def __init__(self, num_target_classes, p: int = 0.3, reshape_size = (72, 72)) -> None:
+    def __init__(self, num_target_classes, p: int = 0.3, reshape_size = (72, 72), in_channels: int = 3) -> None:
         super().__init__()
         self.num_target_classes = num_target_classes
         # init a pretrained resnet
         backbone = models.resnet18()
+        assert in_channels in (1, 3), 'only 3 channel (RGB) and single channel (grayscale) inputs are supported'
+        if in_channels == 1:
+            # the weights of the stem are summed over the RGB channels, so a grayscale crop gets the response
+            # of its 3 channel copy at a third of the first conv cost
+            conv1 = backbone.conv1
+            backbone.conv1 = nn.Conv2d(1, conv1.out_channels, conv1.kernel_size, conv1.stride, conv1.padding, bias=False)
+            backbone.conv1.weight.data = conv1.weight.data.sum(dim=1, keepdim=True)
+        self.in_channels = in_channels
         num_filters = backbone.fc.in_features
         layers = list(backbone.children())[:-1]
 
         self.feature_extractor = nn.Sequential(*layers)
         self.classifier = nn.Linear(num_filters, self.num_target_classes)
 
-        self.transforms = Model2Transforms.registry['resnet18'](reshape_size)
+        self.transforms = Model2Transforms.registry['resnet18'](reshape_size, in_channels)
         self.dropout = nn.Dropout(p=p)
     
     def forward(self, x, get_features=False):
@@ -1,11 +1,14 @@
 from argparse import ArgumentParser
 from pathlib import Path
 import pandas as pd
+import numpy as np
 import utils
 import cv2 as cv
 import logging
 from PIL import Image
 from ThermalClassifier.predictor import Predictor
+from ThermalClassifier.video_pipeline import VideoInferencePipeline
+from ThermalClassifier.prediction_writers import ParquetPredictionsWriter, MemmapPredictionsWriter
 
 parser = ArgumentParser()
 parser.add_argument('--video_path',type=str)
@@ -20,6 +23,19 @@ parser.add_argument('--class_col_name',type=str,default='cls')
 parser.add_argument('--bbox_format',type=str,default='coco')
 parser.add_argument('--frame_limit',type=int,default=500)
 parser.add_argument('--device',type=int,default=None)
+parser.add_argument('--pipelined',action='store_true',help='decode, classify and render concurrently in a single pass over the video')
+parser.add_argument('--queue_size',type=int,default=32)
+parser.add_argument('--batch_size',type=int,default=None,help='classify crops of consecutive frames together in batches of this size')
+parser.add_argument('--max_latency',type=float,default=0.05,help='max seconds a frame waits for its batch to fill')
+parser.add_argument('--temporal_cache',action='store_true',help='reuse the results of objects that barely moved between frames')
+parser.add_argument('--cache_iou_threshold',type=float,default=0.7)
+parser.add_argument('--cache_max_age',type=int,default=30,help='frames after which a cached result is reclassified')
+parser.add_argument('--cache_min_confidence',type=float,default=0.6)
+parser.add_argument('--track_col_name',type=str,default=None,help='match cached results by this track id column instead of IoU')
+
+parser.add_argument('--results_format',type=str,default=None,choices=['parquet','memmap'],help='stream the class probabilities (and embeddings) of every bbox to --results_save_path')
+parser.add_argument('--results_save_path',type=str,default=Path('outputs/results'))
+parser.add_argument('--save_features',action='store_true',help='save the bboxes embeddings with the results')
 
 parser.add_argument('--bbox_save_path',type=str,default=Path('outputs/bboxes/result.csv'))
 parser.add_argument('--rendered_video_save_path',type=str,default=Path('outputs/videos/result.mp4'))
@@ -30,35 +46,71 @@ video_cap = utils.create_video_capture(args.video_path)
 
 # The following raw assumes that all models constructors accept only num of classes as input, not sure that this assumption will hold. 
 
-predictor = Predictor(args.ckpt_path, True, args.device)
+temporal_cache = {'iou_threshold': args.cache_iou_threshold, 'max_age': args.cache_max_age,
+                  'min_confidence': args.cache_min_confidence} if args.temporal_cache else None
+predictor = Predictor(args.ckpt_path, True, args.device, temporal_cache=temporal_cache)
 
 bboxes_df = pd.read_csv(args.video_bboxes_path,index_col=0)
-translated_predictions = []
-while True:
-        frame_num = video_cap.get(cv.CAP_PROP_POS_FRAMES)
-        logging.debug(f'frame number {frame_num} is processed')
-        success, frame = video_cap.read(0)
-        if not success or frame_num >= args.frame_limit:
-            break
-
-        frame = cv.cvtColor(frame, cv.COLOR_BGR2RGB)
-        frame = Image.fromarray(frame)
-
-        frame_related_bboxes = bboxes_df[bboxes_df[args.frame_col_name]==frame_num][args.bbox_col_names].values
-        if len(frame_related_bboxes) == 0:
-            continue
-
-        preds, _ = predictor.predict_frame_bboxes(frame,frame_related_bboxes,args.bbox_format) 
-        translated_predictions.extend(preds)
+extra_cols_names = [args.track_col_name] if args.track_col_name is not None else []
+bboxes_index = utils.FrameBboxIndex.from_df(bboxes_df, args.bbox_col_names, args.frame_col_name, extra_cols_names)
+
+class_names = [predictor.model.idx2class[idx] for idx in range(len(predictor.model.idx2class))]
+results_writer = None
+if args.results_format == 'parquet':
+    results_writer = ParquetPredictionsWriter(Path(args.results_save_path)/'results.parquet', class_names, args.save_features)
+elif args.results_format == 'memmap':
+    results_writer = MemmapPredictionsWriter(args.results_save_path, len(bboxes_df), class_names, args.save_features)
+
+if args.pipelined:
+    # a single pass over the video, the rendering is done by the pipeline writer
+    pipeline = VideoInferencePipeline(predictor, bboxes_index, args.bbox_format, args.frame_limit, args.queue_size,
+                                      args.batch_size, args.max_latency, args.track_col_name, results_writer)
+    translated_predictions = pipeline.run(video_cap, len(bboxes_df), args.rendered_video_save_path)
+
+else:
+    # rows of frames that are not processed (e.g. after frame_limit) are left without a class
+    translated_predictions = np.full(len(bboxes_df), None, dtype=object)
+    batcher = predictor.create_batcher(args.batch_size, args.max_latency, args.bbox_format, 
+                                       get_features=results_writer is not None and args.save_features)
+    frames_row_ids = {}
+    def assign_results(results):
+        for result in results:
+            row_ids = frames_row_ids.pop(result.frame_id)
+            translated_predictions[row_ids] = result.preds
+            if results_writer is not None:
+                results_writer.write(row_ids, result.frame_id, result)
+
+    while True:
+            frame_num = video_cap.get(cv.CAP_PROP_POS_FRAMES)
+            logging.debug(f'frame number {frame_num} is processed')
+            success, frame = video_cap.read(0)
+            if not success or frame_num >= args.frame_limit:
+                break
+
+            frame = cv.cvtColor(frame, cv.COLOR_BGR2RGB)
+            frame = Image.fromarray(frame)
+
+            frame_rows = bboxes_index.get(frame_num)
+            if len(frame_rows.row_ids) == 0:
+                continue
+
+            frames_row_ids[frame_num] = frame_rows.row_ids
+            track_ids = frame_rows.columns[args.track_col_name] if args.track_col_name is not None else None
+            assign_results(batcher.submit(frame_num, frame, frame_rows.bboxes, track_ids, frame_index=int(frame_num)))
+    assign_results(batcher.flush())
+
+if results_writer is not None:
+    results_writer.close()
+
+if predictor.temporal_cache is not None:
+    logging.info(f'temporal cache: {predictor.temporal_cache.stats()}')
         
 bboxes_with_class_predicions = bboxes_df.assign(**{args.class_col_name:translated_predictions})
 
 if args.bbox_save_path is not None:
     bboxes_with_class_predicions.to_csv(args.bbox_save_path)
 
-if args.rendered_video_save_path is not None:
+if args.rendered_video_save_path is not None and not args.pipelined:
     video_cap.set(cv.CAP_PROP_POS_FRAMES, 0)
     utils.draw_video_from_bool_csv(video_cap,bboxes_with_class_predicions,args.bbox_col_names,args.rendered_video_save_path,
-    args.class_col_name,args.bbox_format,args.frame_limit)
-
-
+    args.class_col_name,args.bbox_format,args.frame_limit,args.frame_col_name)
@@ -0,0 +1,147 @@
+import json
+import numpy as np
+from pathlib import Path
+from abc import ABC, abstractmethod
+
+
+class PredictionsWriter(ABC):
+    """
+    Streams the per bbox results of prediction.py (class, class probabilities and optionally the embeddings)
+    to disk as they arrive, rows are identified by their row id in the bboxes csv.
+    """
+    def __init__(self, class_names: list, write_features: bool = False) -> None:
+        self.class_names = list(class_names)
+        self.class2idx = {class_name: idx for idx, class_name in enumerate(self.class_names)}
+        self.write_features = write_features
+
+    def write(self, row_ids, frame_num, result):
+        if len(row_ids) == 0:
+            return
+        probs = result.probs.float().cpu().numpy()
+        features = result.features.float().cpu().numpy() if self.write_features else None
+        self.write_rows(np.asarray(row_ids), frame_num, result.preds, probs, features)
+
+    @abstractmethod
+    def write_rows(self, row_ids, frame_num, preds, probs, features):
+        pass
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ParquetPredictionsWriter(PredictionsWriter):
+    """
+    Buffers chunk_size rows and appends them as a row group to a parquet file with the columns
+    row_id, frame_num, pred, prob_<class> per class and features (a fixed size float32 list).
+    """
+    def __init__(self, path, class_names: list, write_features: bool = False, chunk_size: int = 10000) -> None:
+        super().__init__(class_names, write_features)
+        self.path = Path(path)
+        self.chunk_size = chunk_size
+        self.chunk = []
+        self.num_buffered = 0
+        self.writer = None
+
+    def write_rows(self, row_ids, frame_num, preds, probs, features):
+        self.chunk.append((row_ids, np.full(len(row_ids), frame_num, dtype=np.int64), preds, probs, features))
+        self.num_buffered += len(row_ids)
+        if self.num_buffered >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        if self.num_buffered == 0:
+            return
+
+        row_ids, frame_nums, preds, probs, features = zip(*self.chunk)
+        probs = np.concatenate(probs)
+        columns = {'row_id': pa.array(np.concatenate(row_ids)),
+                   'frame_num': pa.array(np.concatenate(frame_nums)),
+                   'pred': pa.array([pred for frame_preds in preds for pred in frame_preds]).dictionary_encode()}
+        for idx, class_name in enumerate(self.class_names):
+            columns[f'prob_{class_name}'] = pa.array(probs[:, idx])
+        if self.write_features:
+            features = np.ascontiguousarray(np.concatenate(features), dtype=np.float32)
+            columns['features'] = pa.FixedSizeListArray.from_arrays(pa.array(features.reshape(-1)), features.shape[1])
+
+        table = pa.table(columns)
+        if self.writer is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self.writer = pq.ParquetWriter(str(self.path), table.schema)
+        self.writer.write_table(table)
+        self.chunk, self.num_buffered = [], 0
+
+    def close(self):
+        self.flush()
+        if self.writer is not None:
+            self.writer.close()
+
+
+class MemmapPredictionsWriter(PredictionsWriter):
+    """
+    Writes the results in place into memory mapped arrays indexed by row id inside output_dir:
+    preds.npy (int16 class index, -1 for rows that were not classified), frame_nums.npy,
+    probs.npy (float16 [num_rows, num_classes]), features.npy (float16 [num_rows, feature_dim]) and index.json with the classes, shapes and dtypes to open them again.
+    """
+    def __init__(self, output_dir, num_rows: int, class_names: list, write_features: bool = False,
+                 flush_every: int = 10000) -> None:
+        super().__init__(class_names, write_features)
+        self.output_dir = Path(output_dir)
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        self.num_rows = num_rows
+        self.flush_every = flush_every
+        self.written_since_flush = 0
+
+        self.arrays = {'preds': self.create_array('preds', np.int16, (num_rows,), fill=-1),
+                       'frame_nums': self.create_array('frame_nums', np.int64, (num_rows,), fill=-1),
+                       'probs': self.create_array('probs', np.float16, (num_rows, len(self.class_names)))}
+
+    def create_array(self, name, dtype, shape, fill=None):
+        array = np.lib.format.open_memmap(self.output_dir/f'{name}.npy', mode='w+', dtype=dtype, shape=shape)
+        if fill is not None:
+            array[:] = fill
+        return array
+
+    def write_rows(self, row_ids, frame_num, preds, probs, features):
+        self.arrays['preds'][row_ids] = [self.class2idx[pred] for pred in preds]
+        self.arrays['frame_nums'][row_ids] = frame_num
+        self.arrays['probs'][row_ids] = probs
+        if self.write_features:
+            # the embeddings size is known only with the first results
+            if 'features' not in self.arrays:
+                self.arrays['features'] = self.create_array('features', np.float16, (self.num_rows, features.shape[1]))
+            self.arrays['features'][row_ids] = features
+
+        self.written_since_flush += len(row_ids)
+        if self.written_since_flush >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        # writes the dirty pages back so they can be dropped from memory
+        for array in self.arrays.values():
+            array.flush()
+        self.written_since_flush = 0
+
+    def close(self):
+        self.flush()
+        index = {'classes': self.class_names,
+                 'arrays': {name: {'file': Path(array.filename).name, 'dtype': array.dtype.str, 'shape': list(array.shape)}
+                            for name, array in self.arrays.items()}}
+        with open(self.output_dir/'index.json', 'w') as f:
+            json.dump(index, f, indent=2)
+
+
+def load_memmap_predictions(output_dir):
+    output_dir = Path(output_dir)
+    with open(output_dir/'index.json') as f:
+        index = json.load(f)
+    arrays = {name: np.load(output_dir/array_index['file'], mmap_mode='r') for name, array_index in index['arrays'].items()}
+    return index['classes'], arrays
@@ -1,8 +1,18 @@
 import torch
-import gcsfs
-from ThermalClassifier.image_multiclass_trainer import BboxMultiClassClassifier
+import time
+import cv2 as cv
+import logging
+import threading
+from typing import Union
+from torch.fx.experimental.optimization import fuse
 from SoiUtils.general import get_device
-import pybboxes as pbx
+from ThermalClassifier.transforms.batch_transforms import bboxes_to_voc, crop_and_resize, crop_and_resize_uint8
+from ThermalClassifier.batching import FrameMicroBatcher
+from ThermalClassifier.temporal_cache import TemporalResultCache
+from ThermalClassifier.backends import load_exported_model, UInt8Input
+from ThermalClassifier.quantization import quantize_dynamic_head
+from ThermalClassifier.checkpoint_cache import CheckpointCache
+from pathlib import Path
 import numpy as np
 from PIL import Image
 import torchvision.transforms.functional as F
@@ -10,44 +20,296 @@ from SoiUtils.interfaces import Updatable, Classifier
 
 
 class Predictor(Updatable,Classifier):
+    # artifacts created by export.py, any other file is loaded as a lightning checkpoint
+    exported_formats = {'.onnx': 'onnx', '.ts': 'torchscript', '.pt': 'slim'}
+    quantization_modes = (None, 'dynamic', 'static')
+
+    def __init__(self, ckpt_path, load_from_remote=True, device='cpu', temporal_cache: dict = None, 
+                 num_threads: int = None, quantization: str = None, channels_last: bool = False,
+                 compile: Union[bool, dict] = False, fuse_bn: bool = False, bf16: bool = False,
+                 warmup_batch_sizes: list = None, uint8_input: bool = False, fold_normalization: bool = False,
+                 cache_dir: str = None, fs=None):
+        if quantization not in self.quantization_modes:
+            raise ValueError(f'Unsupported quantization {quantization}, choose one of {self.quantization_modes}')
 
-    def __init__(self, ckpt_path, load_from_remote=True, device='cpu'):
         self.device = get_device(device)
+        if quantization is not None and torch.device(self.device).type != 'cpu':
+            raise ValueError('int8 quantized models run only on cpu')
         self.load_from_remote = load_from_remote
-        self.model = self._load_model_from_ckpt(ckpt_path).to(self.device)
+        # any fsspec filesystem to read the checkpoints from, defaults to gcs when load_from_remote
+        self.fs = fs if fs is not None or not load_from_remote else self.create_gcs_filesystem()
+        # with a cache_dir the checkpoints are downloaded once to a local content addressed cache
+        self.checkpoint_cache = CheckpointCache(cache_dir, self.fs) if cache_dir is not None else None
+        # intra op threads of the onnx runtime backend
+        self.num_threads = num_threads
+        # 'dynamic' quantizes the classifier head of a lightning checkpoint on load,
+        # 'static' expects the int8 torchscript model created by quantize.py
+        self.quantization = quantization
+
+        # eager model optimizations, see optimize_model
+        self.channels_last = channels_last
+        # True or torch.compile kwargs, e.g. {'mode': 'max-autotune'}
+        self.compile = compile
+        self.fuse_bn = fuse_bn
+        self.bf16 = bf16 and self.bf16_supported()
+        # the first forward of every batch size is slow (allocations, kernels selection, compilation)
+        self.warmup_batch_sizes = warmup_batch_sizes if warmup_batch_sizes is not None else []
+        # crops are cut and resized in uint8 and the model normalizes them (see UInt8Input)
+        self.uint8_input = uint8_input
+        self.fold_normalization = fold_normalization
+
+        # a model loaded by a background update, swapped in before the next batch
+        self.pending_model = None
+        self.swap_lock = threading.Lock()
+        self.update_thread = None
+        self.update_error = None
+        self.update_stats = {'updates': 0, 'load_time': 0.0, 'warmup_time': 0.0, 'swap_delay': 0.0,
+                             'batches': 0, 'batch_time': 0.0, 'batches_during_update': 0, 'batch_time_during_update': 0.0}
+
+        self.model = self._load_model(ckpt_path)
+        # e.g. {'iou_threshold': 0.7, 'max_age': 30, 'min_confidence': 0.6}, see TemporalResultCache
+        self.temporal_cache = TemporalResultCache(**temporal_cache) if temporal_cache is not None else None
+
+    @staticmethod
+    def create_gcs_filesystem():
+        import gcsfs
+
+        return gcsfs.GCSFileSystem(project="mod-gcp-white-soi-dev-1")
 
     def _load_model_from_ckpt(self, ckpt_path):
-        if self.load_from_remote:
-            fs = gcsfs.GCSFileSystem(project="mod-gcp-white-soi-dev-1")
-            return BboxMultiClassClassifier.load_from_checkpoint(fs.open(ckpt_path, "rb"), map_location='cpu')
-        return BboxMultiClassClassifier.load_from_checkpoint(ckpt_path, map_location='cpu')
+        if self.checkpoint_cache is not None:
+            f = self.checkpoint_cache.get(ckpt_path)
+        elif self.fs is not None:
+            f = self.fs.open(ckpt_path, "rb")
+        else:
+            f = ckpt_path
 
-    def update(self, ckpt_path, **kwargs):
-        self.model = self._load_model_from_ckpt(ckpt_path).to(self.device)
+        model_format = self.exported_formats.get(Path(ckpt_path).suffix)
+        if self.quantization == 'static' and model_format != 'torchscript':
+            raise ValueError(f'static quantization expects the .ts model created by quantize.py, got {ckpt_path}')
+        if model_format is not None:
+            model = load_exported_model(f, model_format, num_threads=self.num_threads)
+        else:
+            # the training stack is imported only for lightning checkpoints
+            from ThermalClassifier.image_multiclass_trainer import BboxMultiClassClassifier
+            model = BboxMultiClassClassifier.load_from_checkpoint(f, map_location='cpu').eval()
 
-    @torch.inference_mode()
-    def predict_frame_bboxes(self, frame:Image, frame_related_bboxes: np.array, bboxes_format: str= 'coco',
-                             get_features: bool = True):
+        if self.quantization == 'dynamic':
+            if not self.is_eager(model):
+                raise ValueError('dynamic quantization applies only to lightning and slim checkpoints')
+            model.model = quantize_dynamic_head(model.model)
+        return model
+
+    def _load_model(self, ckpt_path):
+        start = time.perf_counter()
+        model = self.optimize_model(self._load_model_from_ckpt(ckpt_path).to(self.device))
+        loaded = time.perf_counter()
+        self.warmup(model)
+        self.update_stats['load_time'] = loaded - start
+        self.update_stats['warmup_time'] = time.perf_counter() - loaded
+        return model
+
+    def update(self, ckpt_path, blocking: bool = False, **kwargs):
+        """
+        Loads and warms up the new model on a background thread, the current model keeps serving until
+        the new one is swapped in at the next safe point (see acquire_model). An update waits for the previous one
+        to finish and raises its error if it failed, without starting.
+        """
+        if self.update_thread is not None:
+            self.update_thread.join()
+            self.update_thread = None
+        error, self.update_error = self.update_error, None
+        if error is not None:
+            raise RuntimeError('the previous model update failed, the current model is kept') from error
+        self.update_thread = threading.Thread(target=self._background_update, args=(ckpt_path,), daemon=True)
+        self.update_thread.start()
+        if blocking:
+            self.wait_for_update()
+
+    def _background_update(self, ckpt_path):
+        try:
+            model = self._load_model(ckpt_path)
+        except Exception as e:
+            logging.exception(f'failed to update the model to {ckpt_path}, keeping the current model')
+            self.update_error = e
+            return
+
+        with self.swap_lock:
+            self.pending_model = (model, time.perf_counter())
+
+    def wait_for_update(self):
+        if self.update_thread is not None:
+            self.update_thread.join()
+            self.update_thread = None
+        self.swap_model()
+        error, self.update_error = self.update_error, None
+        if error is not None:
+            raise error
+
+    def acquire_model(self):
+        """
+        Swaps in a pending model and returns the current one. Callers keep the returned model for the preparation,
+        forward and translation of a whole frame, so a swap never happens in the middle of one.
+        """
+        self.swap_model()
+        return self.model
+
+    def swap_model(self):
+        with self.swap_lock:
+            if self.pending_model is None:
+                return
+            (self.model, ready_time), self.pending_model = self.pending_model, None
+        self.update_stats['updates'] += 1
+        self.update_stats['swap_delay'] = time.perf_counter() - ready_time
+        logging.info(f'model updated: {self.update_report()}')
+
+    def update_report(self):
+        stats = self.update_stats
+        return {'updates': stats['updates'],
+                'load_time': stats['load_time'],
+                'warmup_time': stats['warmup_time'],
+                'swap_delay': stats['swap_delay'],
+                'mean_batch_time': stats['batch_time'] / stats['batches'] if stats['batches'] else 0.0,
+                'mean_batch_time_during_update': stats['batch_time_during_update'] / stats['batches_during_update'] \
+                                                 if stats['batches_during_update'] else 0.0,
+                'checkpoint_cache': self.checkpoint_cache.stats() if self.checkpoint_cache is not None else None}
+
+    def bf16_supported(self):
+        device_type = torch.device(self.device).type
+        supported = torch.cuda.is_bf16_supported() if device_type == 'cuda' else \
+                    device_type == 'cpu' and torch.ops.mkldnn._is_mkldnn_bf16_supported()
+        if not supported:
+            logging.warning(f'bf16 is not supported on {self.device}, running in fp32')
+        return supported
+
+    @staticmethod
+    def is_eager(model):
+        # lightning and slim checkpoints, the model can be modified
+        return isinstance(getattr(model, 'model', None), torch.nn.Module)
+
+    def optimize_model(self, model):
+        if not self.is_eager(model):
+            if self.channels_last or self.compile or self.fuse_bn or self.uint8_input:
+                raise ValueError('channels_last, compile, fuse_bn and uint8_input apply only to lightning and slim checkpoints')
+            return model
+
+        if self.fuse_bn:
+            # folds the eval mode batch norms into the preceding convs
+            model.model.feature_extractor = fuse(model.model.feature_extractor)
+        if self.uint8_input:
+            normalize = model.model_transforms.normalize
+            model.model = UInt8Input(model.model, normalize.mean, normalize.std, fold=self.fold_normalization)
+        if self.channels_last:
+            model.model = model.model.to(memory_format=torch.channels_last)
+        if self.compile:
+            compile_kwargs = self.compile if isinstance(self.compile, dict) else {}
+            model.model = torch.compile(model.model, **compile_kwargs)
+        return model
+
+    def warmup(self, model):
+        for batch_size in self.warmup_batch_sizes:
+            resize_shape, in_channels = model.model_transforms.resize_shape, model.model_transforms.in_channels
+            batch = torch.zeros(batch_size, *resize_shape, in_channels, dtype=torch.uint8) if self.uint8_input else \
+                    torch.zeros(batch_size, in_channels, *resize_shape)
+            self.forward(model, batch)
+
+    @staticmethod
+    def get_frame_size(frame):
+        # (W, H) of a PIL image or a [H, W, C] array
+        return frame.size if isinstance(frame, Image.Image) else (frame.shape[1], frame.shape[0])
+
+    @staticmethod
+    def convert_frame(frame, in_channels):
+        # returns a [H, W, C] array, the RGB frames of a single channel model are converted to luma
+        # with the weights of PIL convert('L') used in training
+        if isinstance(frame, Image.Image) and in_channels == 1 and frame.mode != 'L':
+            frame = frame.convert('L')
+        frame = np.asarray(frame)
+        if in_channels == 1 and frame.ndim == 3 and frame.shape[2] == 3:
+            frame = cv.cvtColor(frame, cv.COLOR_RGB2GRAY)
+        return frame[..., None] if frame.ndim == 2 else frame
+
+    def prepare_crops(self, frame, frame_related_bboxes: np.array, bboxes_format: str = 'coco', model=None):
+        model_transforms = (model if model is not None else self.model).model_transforms
+        frame = self.convert_frame(frame, model_transforms.in_channels)
+        if self.uint8_input:
+            voc_bboxes = bboxes_to_voc(frame_related_bboxes, bboxes_format, (frame.shape[1], frame.shape[0]))
+            return crop_and_resize_uint8(frame, voc_bboxes, model_transforms.resize_shape)
 
-        frame_crops_according_to_bboxes = []
-        frame_size = frame.size
         frame = F.to_tensor(frame)
+        frame_size = (frame.shape[2], frame.shape[1])
 
-        for i in range(frame_related_bboxes.shape[0]):
-            frame_related_bbox = frame_related_bboxes[i,:]
-            x0, y0, x1, y1 = pbx.convert_bbox(frame_related_bbox, from_type=bboxes_format, to_type="voc", image_size=frame_size)
-            frame_crops_according_to_bboxes.append(self.model.model_transforms(frame[:, y0: y1, x0: x1]))
+        voc_bboxes = bboxes_to_voc(frame_related_bboxes, bboxes_format, frame_size)
+        crops = crop_and_resize(frame, voc_bboxes, model_transforms.resize_shape)
+        return model_transforms.normalize(crops)
 
-        batch = torch.stack(frame_crops_according_to_bboxes, dim=0).to(self.device)
-        
-        
-        logits, features = self.model.predict_step(batch, get_features=get_features)
+    @torch.inference_mode()
+    def predict_crops(self, batch, get_features: bool = True, model=None):
+        # model: the one the crops were prepared for, by default a model loaded in the background is swapped in first
+        model = model if model is not None else self.acquire_model()
+        updating = self.update_thread is not None and self.update_thread.is_alive()
+        start = time.perf_counter()
+        outputs = self.forward(model, batch, get_features)
+
+        batch_time = time.perf_counter() - start
+        self.update_stats['batches'] += 1
+        self.update_stats['batch_time'] += batch_time
+        if updating:
+            self.update_stats['batches_during_update'] += 1
+            self.update_stats['batch_time_during_update'] += batch_time
+        return outputs
+
+    @torch.inference_mode()
+    def forward(self, model, batch, get_features: bool = True):
+        batch = batch.to(self.device)
+        if self.channels_last and not self.uint8_input:
+            batch = batch.contiguous(memory_format=torch.channels_last)
 
+        with torch.autocast(torch.device(self.device).type, dtype=torch.bfloat16, enabled=self.bf16):
+            logits, features = model.predict_step(batch, get_features=get_features)
+        if self.bf16:
+            logits, features = logits.float(), (features.float() if features is not None else None)
+        return logits, features
+
+    def translate_logits(self, logits, model=None):
+        idx2class = (model if model is not None else self.model).idx2class
         preds = logits.argmax(axis=1).tolist()
-        translated_preds = list(map(lambda x: self.model.idx2class[x], preds))
+        return list(map(lambda x: idx2class[x], preds))
+
+    @torch.inference_mode()
+    def predict_frame_bboxes(self, frame:Image, frame_related_bboxes: np.array, bboxes_format: str= 'coco',
+                             get_features: bool = True, track_ids: list = None, frame_index: int = None):
+
+        if self.temporal_cache is not None:
+            return self.predict_frame_bboxes_with_cache(frame, frame_related_bboxes, bboxes_format, get_features, track_ids,
+                                                        frame_index)
+
+        model = self.acquire_model()
+        batch = self.prepare_crops(frame, frame_related_bboxes, bboxes_format, model)
+        
+        logits, features = self.predict_crops(batch, get_features=get_features, model=model)
         
-        return translated_preds, features
+        return self.translate_logits(logits, model), features
+
+    def predict_frame_bboxes_with_cache(self, frame, frame_related_bboxes, bboxes_format, get_features, track_ids,
+                                        frame_index=None):
+        voc_bboxes = bboxes_to_voc(frame_related_bboxes, bboxes_format, self.get_frame_size(frame))
+        lookup = self.temporal_cache.lookup(voc_bboxes, track_ids, require_features=get_features, frame_index=frame_index)
+
+        preds, probs, features = [], None, None
+        if len(lookup.missed) > 0:
+            model = self.acquire_model()
+            batch = self.prepare_crops(frame, voc_bboxes[lookup.missed], 'voc', model)
+            logits, features = self.predict_crops(batch, get_features=get_features, model=model)
+            preds, probs = self.translate_logits(logits, model), logits.softmax(dim=1)
+
+        preds, _, features = self.temporal_cache.update(lookup, preds, probs, features)
+        return preds, features
 
+    def create_batcher(self, batch_size: int = 64, max_latency: float = 0.05, bboxes_format: str = 'coco', 
+                       get_features: bool = True):
+        # Classifies crops of several frames together, see FrameMicroBatcher
+        return FrameMicroBatcher(self, batch_size, max_latency, bboxes_format, get_features)
 
     def classify(self,*args,**kwargs):
         return self.predict_frame_bboxes(*args,**kwargs)
@@ -0,0 +1,77 @@
+import copy
+import time
+import torch
+import torch.nn as nn
+from ThermalClassifier.backends import FeaturesAndLogits
+from ThermalClassifier.metrics import ConfusionMatrix, confusion_matrix_metrics
+
+
+def quantize_static(lightning_model, calibration_loader, num_batches: int = 32, backend: str = 'x86'):
+    """
+    Post training static int8 quantization (FX graph mode) of the whole model, calibrated on num_batches of the loader.
+    Returns a FeaturesAndLogits like module that runs on CPU.
+    """
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+    torch.backends.quantized.engine = backend
+    module = FeaturesAndLogits(copy.deepcopy(lightning_model.model).cpu()).eval()
+    model_transforms = lightning_model.model_transforms
+    example_inputs = (torch.zeros(1, model_transforms.in_channels, *model_transforms.resize_shape),)
+    prepared = prepare_fx(module, get_default_qconfig_mapping(backend), example_inputs=example_inputs)
+
+    with torch.inference_mode():
+        for batch_idx, (imgs, *_) in enumerate(calibration_loader):
+            if batch_idx >= num_batches:
+                break
+            prepared(imgs)
+
+    return convert_fx(prepared)
+
+
+def quantize_dynamic_head(model: nn.Module):
+    # only the linear classifier head is quantized, its activations are quantized on the fly
+    return torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+
+def compare_models(models: dict, dataloader, num_classes, max_batches: int = None):
+    """
+    Runs every model (anything with predict_step) on the same batches and returns per model
+    the per class metrics and the forward latency / throughput.
+    """
+    # same metrics as BboxMultiClassClassifier
+    confusion_matrices = {name: ConfusionMatrix(num_classes) for name in models}
+    forward_times = {name: 0.0 for name in models}
+    num_samples, num_batches = 0, 0
+
+    with torch.inference_mode():
+        for batch_idx, (imgs, labels, *_) in enumerate(dataloader):
+            if max_batches is not None and batch_idx >= max_batches:
+                break
+            for name, model in models.items():
+                start = time.perf_counter()
+                logits, _ = model.predict_step(imgs)
+                forward_times[name] += time.perf_counter() - start
+                confusion_matrices[name].update(logits.float(), labels)
+            num_samples += len(labels)
+            num_batches += 1
+
+    return {name: {'metrics': confusion_matrix_metrics(confusion_matrices[name].matrix[0]),
+                   'latency_per_batch': forward_times[name] / num_batches if num_batches else 0.0,
+                   'throughput': num_samples / forward_times[name] if forward_times[name] else 0.0}
+            for name in models}
+
+
+def create_data_module(cfg, root_data_dir, lightning_model, batch_size: int = 256, num_workers: int = 8):
+    # the evaluation datasets of a training config (see main.py), transformed for the given model.
+    # the train only options are dropped, with batch_augmentation the loaders would return un-normalized crops
+    from ThermalClassifier.data_module import GenericDataModule
+
+    return GenericDataModule.from_config(cfg, root_data_dir, lightning_model.class2idx,
+                                         lightning_model.get_model_transforms(),
+                                         batch_augmentation=False,
+                                         train_sampler=None,
+                                         val_batch_size=batch_size,
+                                         test_batch_size=batch_size,
+                                         val_num_workers=num_workers,
+                                         test_num_workers=num_workers)
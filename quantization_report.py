@@ -0,0 +1,54 @@
+from argparse import ArgumentParser
+import torch
+from SoiUtils.load import load_yaml
+from ThermalClassifier.predictor import Predictor
+from ThermalClassifier.quantization import compare_models, create_data_module
+
+
+def print_report(results, idx2class):
+    names = list(results)
+    fp32 = results[names[0]]
+    print(f'{"model":<10}{"latency/batch [ms]":>20}{"throughput [crops/s]":>22}{"speedup":>10}')
+    for name in names:
+        result = results[name]
+        speedup = fp32['latency_per_batch'] / result['latency_per_batch'] if result['latency_per_batch'] else 0.0
+        print(f'{name:<10}{result["latency_per_batch"] * 1000:>20.2f}{result["throughput"]:>22.1f}{speedup:>10.2f}')
+
+    print()
+    metric_names = list(fp32['metrics'])
+    print(f'{"class":<15}{"model":<10}' + ''.join(f'{metric_name:>22}' for metric_name in metric_names))
+    for idx, class_name in idx2class.items():
+        for name in names:
+            values = ''.join(f'{results[name]["metrics"][metric_name][idx].item():>22.4f}' for metric_name in metric_names)
+            print(f'{class_name:<15}{name:<10}' + values)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--config_path', type=str, required=True, help='training YAML, its test_datasets are evaluated')
+    parser.add_argument('--root_data_dir', type=str, required=True)
+    parser.add_argument('--ckpt_path', type=str, required=True, help='fp32 lightning checkpoint')
+    parser.add_argument('--static_ckpt_path', type=str, help='int8 model created by quantize.py')
+    parser.add_argument('--load_from_remote', action='store_true')
+    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--num_workers', type=int, default=8)
+    parser.add_argument('--max_batches', type=int, default=None)
+    parser.add_argument('--num_threads', type=int, default=None, help='torch intra op threads, e.g. the edge device cores')
+    args = parser.parse_args()
+
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+
+    cfg = load_yaml(args.config_path)
+    models = {'fp32': Predictor(args.ckpt_path, args.load_from_remote, 'cpu').model,
+              'dynamic': Predictor(args.ckpt_path, args.load_from_remote, 'cpu', quantization='dynamic').model}
+    if args.static_ckpt_path is not None:
+        models['static'] = Predictor(args.static_ckpt_path, args.load_from_remote, 'cpu', quantization='static').model
+
+    fp32_model = models['fp32']
+    data_module = create_data_module(cfg, args.root_data_dir, fp32_model, args.batch_size, args.num_workers)
+    data_module.prepare_data()
+    data_module.setup('test')
+
+    results = compare_models(models, data_module.test_dataloader(), len(fp32_model.idx2class), args.max_batches)
+    print_report(results, fp32_model.idx2class)
@@ -0,0 +1,35 @@
+from argparse import ArgumentParser
+from pathlib import Path
+from SoiUtils.load import load_yaml
+from ThermalClassifier.predictor import Predictor
+from ThermalClassifier.backends import export_torchscript
+from ThermalClassifier.quantization import quantize_static, create_data_module
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--config_path', type=str, required=True, help='training YAML, its val_datasets are used for calibration')
+    parser.add_argument('--root_data_dir', type=str, required=True)
+    parser.add_argument('--ckpt_path', type=str, required=True)
+    parser.add_argument('--load_from_remote', action='store_true')
+    parser.add_argument('--output_dir', type=str, default='weights')
+    parser.add_argument('--num_calibration_batches', type=int, default=32)
+    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--num_workers', type=int, default=8)
+    parser.add_argument('--backend', type=str, default='x86', choices=['x86', 'fbgemm', 'qnnpack'],
+                        help='qnnpack for ARM edge devices')
+    args = parser.parse_args()
+
+    cfg = load_yaml(args.config_path)
+    lightning_model = Predictor(args.ckpt_path, args.load_from_remote, 'cpu').model
+
+    data_module = create_data_module(cfg, args.root_data_dir, lightning_model, args.batch_size, args.num_workers)
+    data_module.prepare_data()
+    data_module.setup('validate')
+    quantized = quantize_static(lightning_model, data_module.val_dataloader(), args.num_calibration_batches, args.backend)
+
+    output_dir = Path(args.output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    output_path = output_dir/f'{Path(args.ckpt_path).stem}_int8.ts'
+    export_torchscript(lightning_model, output_path, module=quantized)
+    print(f'exported {output_path}, load it with Predictor(..., quantization="static")')
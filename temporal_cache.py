@@ -0,0 +1,156 @@
+import numpy as np
+import torch
+from dataclasses import dataclass
+from typing import List, Union
+
+
+def pairwise_iou(boxes_a: np.ndarray, boxes_b: np.ndarray):
+    # voc boxes [N, 4] and [M, 4] -> [N, M]
+    x0 = np.maximum(boxes_a[:, None, 0], boxes_b[None, :, 0])
+    y0 = np.maximum(boxes_a[:, None, 1], boxes_b[None, :, 1])
+    x1 = np.minimum(boxes_a[:, None, 2], boxes_b[None, :, 2])
+    y1 = np.minimum(boxes_a[:, None, 3], boxes_b[None, :, 3])
+    intersection = np.clip(x1 - x0, 0, None) * np.clip(y1 - y0, 0, None)
+
+    area_a = (boxes_a[:, 2] - boxes_a[:, 0]) * (boxes_a[:, 3] - boxes_a[:, 1])
+    area_b = (boxes_b[:, 2] - boxes_b[:, 0]) * (boxes_b[:, 3] - boxes_b[:, 1])
+    union = area_a[:, None] + area_b[None, :] - intersection
+    return np.where(union > 0, intersection / np.maximum(union, 1e-9), 0.0)
+
+
+@dataclass
+class CachedResult:
+    box: np.ndarray
+    # None until the result of the bbox is computed (see TemporalResultCache.update)
+    pred: Union[str, None]
+    probs: Union[torch.Tensor, None]
+    features: Union[torch.Tensor, None]
+    classified_at: int
+    last_seen: int
+
+    @property
+    def ready(self):
+        return self.pred is not None
+
+
+@dataclass
+class CacheLookup:
+    frame_index: int
+    entries: List[CachedResult]
+    reused: List[bool]
+
+    @property
+    def missed(self):
+        return [i for i, reused in enumerate(self.reused) if not reused]
+
+
+class TemporalResultCache:
+    """
+    Reuses the class, probabilities and features of objects that barely moved since they were classified.
+    A bbox is matched to the previous results by its track id when given, otherwise one to one with the bboxes of the
+    previous frame with bboxes, greedily by descending IoU. A match is reused when its IoU >= iou_threshold, it was classified less than
+    max_age frames ago and its confidence was >= min_confidence.
+    The bboxes of a lookup become the previous frame right away and their results are filled in by update, so with
+    the FrameMicroBatcher the next frame is matched against this one even before its results are ready
+    (a match whose result is still pending is classified again).
+    """
+    def __init__(self, iou_threshold: float = 0.7, max_age: int = 30, min_confidence: float = 0.6) -> None:
+        self.iou_threshold = iou_threshold
+        self.max_age = max_age
+        self.min_confidence = min_confidence
+
+        self.frame_index = 0
+        self.tracks = {}
+        self.previous_entries = []
+
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.low_confidence = 0
+        self.pending = 0
+
+    def match(self, voc_bboxes, track_ids):
+        if track_ids is not None:
+            candidates = [self.tracks.get(track_id) for track_id in track_ids]
+            ious = [pairwise_iou(voc_bboxes[i: i + 1], candidate.box[None])[0, 0] if candidate is not None else 0.0
+                    for i, candidate in enumerate(candidates)]
+            return candidates, ious
+
+        if len(self.previous_entries) == 0 or len(voc_bboxes) == 0:
+            return [None] * len(voc_bboxes), [0.0] * len(voc_bboxes)
+
+        ious = pairwise_iou(voc_bboxes, np.stack([entry.box for entry in self.previous_entries]))
+        # every previous object is taken by a single bbox, the pairs below iou_threshold are never reused
+        candidates, matched_ious, taken = [None] * len(voc_bboxes), [0.0] * len(voc_bboxes), set()
+        for i, j in zip(*np.unravel_index(np.argsort(-ious, axis=None, kind='stable'), ious.shape)):
+            if ious[i, j] < self.iou_threshold:
+                break
+            if candidates[i] is not None or j in taken:
+                continue
+            candidates[i], matched_ious[i] = self.previous_entries[j], float(ious[i, j])
+            taken.add(j)
+        return candidates, matched_ious
+
+    def lookup(self, voc_bboxes: np.ndarray, track_ids=None, require_features: bool = False, frame_index: int = None):
+        """
+        frame_index: the frame number in the video, so the ages count real frames also when the frames without bboxes
+        are skipped. Without it every lookup is a new frame.
+        """
+        self.frame_index = self.frame_index + 1 if frame_index is None else frame_index
+        candidates, ious = self.match(voc_bboxes, track_ids)
+
+        entries, reused = [], []
+        for box, candidate, iou in zip(voc_bboxes, candidates, ious):
+            reusable = candidate is not None and iou >= self.iou_threshold
+            if reusable and not candidate.ready:
+                self.pending += 1
+                reusable = False
+            reusable = reusable and (candidate.features is not None or not require_features)
+            if reusable and self.frame_index - candidate.classified_at >= self.max_age:
+                self.expired += 1
+                reusable = False
+            elif reusable and candidate.probs.max().item() < self.min_confidence:
+                self.low_confidence += 1
+                reusable = False
+
+            # reused results move with their object
+            entries.append(CachedResult(box, candidate.pred, candidate.probs, candidate.features,
+                                        candidate.classified_at, self.frame_index) if reusable else
+                           CachedResult(box, None, None, None, self.frame_index, self.frame_index))
+            reused.append(reusable)
+            self.hits += reusable
+            self.misses += not reusable
+
+        if track_ids is not None:
+            self.tracks.update(zip(track_ids, entries))
+            self.tracks = {track_id: entry for track_id, entry in self.tracks.items()
+                           if self.frame_index - entry.last_seen < self.max_age}
+        elif len(entries) > 0:
+            # a frame without bboxes keeps the previous ones, they still expire after max_age frames
+            self.previous_entries = entries
+
+        return CacheLookup(self.frame_index, entries, reused)
+
+    def update(self, lookup: CacheLookup, preds, probs, features=None):
+        """
+        Fills in the results of the missed bboxes (in lookup.missed order) and returns the preds, probs and features
+        of all the bboxes.
+        """
+        entries = lookup.entries
+        for j, i in enumerate(lookup.missed):
+            entries[i].pred, entries[i].probs = preds[j], probs[j]
+            entries[i].features = features[j] if features is not None else None
+
+        merged_features = torch.stack([entry.features for entry in entries]) \
+                            if len(entries) > 0 and all(entry.features is not None for entry in entries) else None
+        merged_probs = torch.stack([entry.probs for entry in entries]) if len(entries) > 0 else torch.empty(0)
+        return [entry.pred for entry in entries], merged_probs, merged_features
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'expired': self.expired,
+                'low_confidence': self.low_confidence,
+                'pending': self.pending}
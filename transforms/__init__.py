@@ -1,65 +1,54 @@
 from ThermalClassifier.transforms.general_transforms import AddShape, ToTensor, RandomHorizontalFlip, RandomVerticalFlip, RandomRotation, \
-                                    RandomDownSampleImage, SampleBackground, CropImage, SelectCropCoordinates
+                                    RandomDownSampleImage, SampleBackground, CropImage, SelectCropCoordinates, AddRotationMargin
 from torchvision.transforms import Compose
 
 
-def hit_uav_transforms(deterministic, class2idx, area_scale=[1, 2]):
-    return Compose([ToTensor(),
-                    SampleBackground(class2idx, deterministic, p=0.2),
-                    # RandomDownSampleImage(down_scale_factor_range=[0.7, 1], p=0.3),
-                    AddShape(),
-                    SelectCropCoordinates(class2idx, area_scale, ratio=[1, 1.5], deterministic=deterministic),
-                    CropImage(),
-                    RandomHorizontalFlip(p=0.5),
-                    RandomVerticalFlip(p=0.5),
-                    RandomRotation(degrees=(0, 45)),
-                    ])
+def crop_transforms(deterministic, class2idx, area_scale, ratio, crop_first=False, augment=True, rotation_degrees=(0, 45)):
+    """
+    crop_first: Select the crop from the image metadata and crop the PIL image (with margin for the rotation)
+                before ToTensor, so only the crop is converted to a float tensor.
+    augment: When False the flips and rotation are left out, they are applied on the batch by BatchAugmentation.
+    """
+    if crop_first:
+        crop = [SampleBackground(class2idx, deterministic, p=0.2),
+                AddShape(),
+                SelectCropCoordinates(class2idx, area_scale, ratio=ratio, deterministic=deterministic)]
+        if augment:
+            crop.append(AddRotationMargin(degrees=rotation_degrees))
+        crop += [CropImage(),
+                 ToTensor()]
+    else:
+        crop = [ToTensor(),
+                SampleBackground(class2idx, deterministic, p=0.2),
+                AddShape(),
+                SelectCropCoordinates(class2idx, area_scale, ratio=ratio, deterministic=deterministic),
+                CropImage()]
 
-def monet_transforms(deterministic, class2idx, area_scale=[0.5, 2]):
-    return Compose([ToTensor(),
-                    SampleBackground(class2idx, deterministic, p=0.2),
-                    # RandomDownSampleImage(down_scale_factor_range=[0.85, 1], p=0.3),
-                    AddShape(),
-                    SelectCropCoordinates(class2idx, area_scale, ratio=[1, 1.5], deterministic=deterministic),
-                    CropImage(),
-                    RandomHorizontalFlip(p=0.5),
-                    RandomVerticalFlip(p=0.5),
-                    RandomRotation(degrees=(0, 45)),
-                    ])
+    if not augment:
+        return Compose(crop)
 
-def kitti_transforms(deterministic, class2idx, area_scale=[1, 1]):
-    return Compose([ToTensor(),
-                    SampleBackground(class2idx, deterministic, p=0.2),
-                    AddShape(),
-                    SelectCropCoordinates(class2idx, area_scale, ratio=[1, 1], deterministic=deterministic),
-                    CropImage(),
-                    RandomHorizontalFlip(p=0.5),
-                    RandomVerticalFlip(p=0.5),
-                    RandomRotation(degrees=(0, 45)),
-                    ])
+    return Compose(crop + [RandomHorizontalFlip(p=0.5),
+                           RandomVerticalFlip(p=0.5),
+                           RandomRotation(degrees=rotation_degrees)])
 
-def soda_d_transforms(deterministic, class2idx, area_scale=[0.5, 2]):
-    return Compose([ToTensor(),
-                    SampleBackground(class2idx, deterministic, p=0.2),
-                    # RandomDownSampleImage(down_scale_factor_range=[0.8, 1], p=0.3),
-                    AddShape(),
-                    SelectCropCoordinates(class2idx, area_scale, ratio=[1, 1.5], deterministic=deterministic),
-                    CropImage(),
-                    RandomHorizontalFlip(p=0.5),
-                    RandomVerticalFlip(p=0.5),
-                    RandomRotation(degrees=(0, 45))
-                    ])
 
-def soi_transforms(deterministic, class2idx, area_scale=[1, 2]):
-    return Compose([ToTensor(),
-                    SampleBackground(class2idx, deterministic, p=0.2),
-                    AddShape(),
-                    SelectCropCoordinates(class2idx, area_scale, ratio=[1, 1.5], deterministic=deterministic),
-                    CropImage(),
-                    RandomHorizontalFlip(p=0.5),
-                    RandomVerticalFlip(p=0.5),
-                    RandomRotation(degrees=(0, 45)),
-                    ])
+def hit_uav_transforms(deterministic, class2idx, area_scale=[1, 2], **kwargs):
+    # RandomDownSampleImage(down_scale_factor_range=[0.7, 1], p=0.3),
+    return crop_transforms(deterministic, class2idx, area_scale, ratio=[1, 1.5], **kwargs)
+
+def monet_transforms(deterministic, class2idx, area_scale=[0.5, 2], **kwargs):
+    # RandomDownSampleImage(down_scale_factor_range=[0.85, 1], p=0.3),
+    return crop_transforms(deterministic, class2idx, area_scale, ratio=[1, 1.5], **kwargs)
+
+def kitti_transforms(deterministic, class2idx, area_scale=[1, 1], **kwargs):
+    return crop_transforms(deterministic, class2idx, area_scale, ratio=[1, 1], **kwargs)
+
+def soda_d_transforms(deterministic, class2idx, area_scale=[0.5, 2], **kwargs):
+    # RandomDownSampleImage(down_scale_factor_range=[0.8, 1], p=0.3),
+    return crop_transforms(deterministic, class2idx, area_scale, ratio=[1, 1.5], **kwargs)
+
+def soi_transforms(deterministic, class2idx, area_scale=[1, 2], **kwargs):
+    return crop_transforms(deterministic, class2idx, area_scale, ratio=[1, 1.5], **kwargs)
 
 datasets_transforms ={
     'hit-uav': hit_uav_transforms,
@@ -67,4 +56,4 @@ datasets_transforms ={
     'kitti': kitti_transforms,
     'SODA-D': soda_d_transforms,
     'SOI': soi_transforms
-}
\ No newline at end of file
+}
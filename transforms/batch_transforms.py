@@ -0,0 +1,120 @@
+import torch
+import numpy as np
+import torch.nn.functional as F
+from torchvision.ops import roi_align
+
+
+class BatchAugmentation():
+    """
+    The flips and rotation of the datasets transforms followed by the model normalization,
+    applied on a whole batch of fixed size crops with random parameters per sample.
+    """
+    def __init__(self, normalize, hflip_p: float = 0.5, vflip_p: float = 0.5, degrees: tuple = (0, 45)) -> None:
+        self.normalize = normalize
+        self.hflip_p = hflip_p
+        self.vflip_p = vflip_p
+        self.degrees = degrees
+
+    @staticmethod
+    def random_flip(images, p, dim):
+        flip = torch.rand(images.shape[0], device=images.device) < p
+        return torch.where(flip[:, None, None, None], images.flip(dim), images)
+
+    def random_rotation(self, images):
+        # images are [B, C, H, W], same integer angles and nearest interpolation as RandomRotation
+        B, _, H, W = images.shape
+        angles = torch.deg2rad(torch.randint(*self.degrees, (B,), device=images.device).to(images.dtype))
+        cos, sin, zeros = angles.cos(), angles.sin(), torch.zeros_like(angles)
+
+        # counter clockwise rotation in the normalized coordinates of affine_grid
+        theta = torch.stack([torch.stack([cos, -sin * H / W, zeros], dim=1),
+                             torch.stack([sin * W / H, cos, zeros], dim=1)], dim=1)
+        grid = F.affine_grid(theta, list(images.shape), align_corners=False)
+        return F.grid_sample(images, grid, mode='nearest', padding_mode='zeros', align_corners=False)
+
+    def __call__(self, images: torch.Tensor, augment: bool = True):
+        if augment:
+            images = self.random_flip(images, self.hflip_p, dim=-1)
+            images = self.random_flip(images, self.vflip_p, dim=-2)
+            images = self.random_rotation(images)
+        return self.normalize(images)
+
+
+def bboxes_to_voc(bboxes: np.ndarray, bboxes_format: str, image_size: tuple):
+    """
+    Vectorized pbx.convert_bbox(..., to_type='voc') for a [N, 4] array, returns int (x0, y0, x1, y1) clipped to the image.
+    """
+    W, H = image_size
+    bboxes = np.asarray(bboxes, dtype=np.float64).reshape(-1, 4)
+    a, b, c, d = bboxes.T
+
+    if bboxes_format == 'voc':
+        voc = np.stack([a, b, c, d], axis=1)
+    elif bboxes_format == 'coco':
+        voc = np.stack([a, b, a + c, b + d], axis=1)
+    elif bboxes_format == 'yolo':
+        voc = np.stack([(a - c / 2) * W, (b - d / 2) * H, (a + c / 2) * W, (b + d / 2) * H], axis=1)
+    elif bboxes_format == 'albumentations':
+        voc = np.stack([a * W, b * H, c * W, d * H], axis=1)
+    elif bboxes_format == 'fiftyone':
+        voc = np.stack([a * W, b * H, (a + c) * W, (b + d) * H], axis=1)
+    else:
+        raise ValueError(f'Unsupported bbox format {bboxes_format}')
+
+    voc = np.round(voc).astype(np.int64)
+    voc[:, 0::2] = np.clip(voc[:, 0::2], 0, W)
+    voc[:, 1::2] = np.clip(voc[:, 1::2], 0, H)
+    return voc
+
+
+def crop_and_resize(image: torch.Tensor, voc_bboxes: np.ndarray, size: tuple):
+    """
+    Crops all the bboxes out of a [C, H, W] image and bilinearly resizes them to size in a single roi_align call.
+    The samples match Resize(antialias=False) of every crop, except that the crop borders are interpolated
+    with the neighbouring frame pixels instead of being clamped.
+    """
+    boxes = torch.as_tensor(voc_bboxes, dtype=image.dtype, device=image.device).reshape(-1, 4)
+    boxes = torch.cat([torch.zeros_like(boxes[:, :1]), boxes], dim=1)
+    return roi_align(image.unsqueeze(0), boxes, output_size=tuple(size), spatial_scale=1.0,
+                     sampling_ratio=1, aligned=True)
+
+
+def linear_sampling(start, end, out_size: int):
+    """
+    Source pixels and weights of a 1d bilinear resize of the [start, end) ranges of every crop to out_size, with the
+    half pixel centers and the clamped borders of cv2 INTER_LINEAR. Returns the [N, out_size] low and high pixel
+    indices and the float32 weight of the high pixel.
+    """
+    last = (end - start - 1)[:, None]
+    coords = (np.arange(out_size) + 0.5)[None] * ((end - start) / out_size)[:, None] - 0.5
+    coords = np.clip(coords, 0, last)
+    low = np.floor(coords).astype(np.int64)
+    high = np.minimum(low + 1, last)
+    return low + start[:, None], high + start[:, None], (coords - low).astype(np.float32)
+
+
+def crop_and_resize_uint8(image: np.ndarray, voc_bboxes: np.ndarray, size: tuple):
+    """
+    Crops all the bboxes out of a uint8 [H, W, C] image and bilinearly resizes them to size, returns uint8 [N, *size, C].
+    All the crops are resized together by gathering the 4 source pixels of every output pixel, only those are converted
+    to float for the interpolation (the frame stays uint8). Matches a cv2 INTER_LINEAR resize of every crop up to
+    rounding, the conversion of the crops to float is left to the model (see UInt8Input).
+    """
+    H, W = image.shape[:2]
+    voc = np.asarray(voc_bboxes, dtype=np.int64).reshape(-1, 4)
+    # degenerated bboxes are grown to a single pixel
+    x0, y0 = np.minimum(voc[:, 0], W - 1), np.minimum(voc[:, 1], H - 1)
+    x1, y1 = np.maximum(voc[:, 2], x0 + 1), np.maximum(voc[:, 3], y0 + 1)
+
+    y_low, y_high, y_weight = linear_sampling(y0, y1, size[0])
+    x_low, x_high, x_weight = linear_sampling(x0, x1, size[1])
+    y_low, y_high, y_weight = y_low[:, :, None], y_high[:, :, None], y_weight[:, :, None, None]
+    x_low, x_high, x_weight = x_low[:, None, :], x_high[:, None, :], x_weight[:, None, :, None]
+
+    # [N, h, w, C] gathers
+    top_left, top_right = image[y_low, x_low].astype(np.float32), image[y_low, x_high].astype(np.float32)
+    bottom_left, bottom_right = image[y_high, x_low].astype(np.float32), image[y_high, x_high].astype(np.float32)
+    top = top_left + (top_right - top_left) * x_weight
+    bottom = bottom_left + (bottom_right - bottom_left) * x_weight
+    crops = np.rint(top + (bottom - top) * y_weight).astype(np.uint8)
+    return torch.from_numpy(crops)
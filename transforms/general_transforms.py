@@ -3,8 +3,10 @@ import numpy as np
 from typing import Tuple
 from pybboxes import BoundingBox
 import random
+import math
+from PIL import Image
 from torchvision import transforms
-from torchvision.transforms.functional import resize, hflip, vflip, rotate
+from torchvision.transforms.functional import resize, hflip, vflip, rotate, to_tensor
 
 
 class RandomDownSampleImage():
@@ -22,6 +24,14 @@ class RandomDownSampleImage():
             sample.bbox.scale(down_scale_factor ** 2)
         return sample
 
+class Resize():
+    def __init__(self, size: tuple) -> None:
+        self.size = size
+
+    def __call__(self, sample: BboxSample):
+        sample.image = resize(sample.image, size=self.size, antialias=False)
+        return sample
+
 class ToTensor():
     def __init__(self) -> None:
         self.transform = transforms.ToTensor()
@@ -55,6 +65,12 @@ class RandomRotation():
     def __call__(self, sample: BboxSample):
         angle = np.random.randint(*self.degrees)
         sample.image = rotate(sample.image, angle)
+
+        # The crop was taken with context around it (see AddRotationMargin), cut back the center
+        if 'rotation_margin' in sample.metadata:
+            margin_x, margin_y = sample.metadata.pop('rotation_margin')
+            _, h, w = sample.image.shape
+            sample.image = sample.image[:, margin_y: h - margin_y, margin_x: w - margin_x]
         return sample
 
 class SampleBackground():
@@ -66,15 +82,25 @@ class SampleBackground():
             np.random.seed(42)
 
     def __call__(self, sample: BboxSample):
+        # crop stores provide a crop sampled away from the annotations of the frame (see build_crop_store)
+        background = sample.metadata.pop('background_image', None)
         if random.random() < self.p:
             sample.label = self.class2idx['BACKGROUND']
+            if background is not None:
+                sample.image = background if isinstance(sample.image, (np.ndarray, Image.Image)) else to_tensor(background)
         
         return sample
     
 class AddShape():
     def __call__(self,sample:BboxSample):
         metadata = sample.metadata
-        _, metadata['H'], metadata['W'] = sample.image.shape
+        if isinstance(sample.image, Image.Image):
+            metadata['W'], metadata['H'] = sample.image.size
+        elif isinstance(sample.image, np.ndarray):
+            # numpy images are [H, W, C]
+            metadata['H'], metadata['W'] = sample.image.shape[:2]
+        else:
+            _, metadata['H'], metadata['W'] = sample.image.shape
         return sample
     
 class SelectCropCoordinates:
@@ -135,8 +161,47 @@ class SelectCropCoordinates:
         h = min(h, image_h)
         return w, h
 
+class AddRotationMargin():
+    """
+    Extends the selected crop with the context needed to rotate it by up to max(degrees)
+    without black corners, RandomRotation cuts the center back after rotating.
+    The margins are symmetric so flips keep the crop centered.
+    """
+    def __init__(self, degrees: tuple) -> None:
+        self.max_angle = math.radians(max(degrees))
+
+    def required_margin(self, w, h):
+        # half extents of a w x h rectangle rotated by angle are (w/2)cos + (h/2)sin and (w/2)sin + (h/2)cos
+        def max_half_extent(a, b):
+            if self.max_angle >= math.atan2(b, a):
+                return math.hypot(a, b)
+            return a * math.cos(self.max_angle) + b * math.sin(self.max_angle)
+
+        margin_x = math.ceil(max_half_extent(w / 2, h / 2) - w / 2)
+        margin_y = math.ceil(max_half_extent(h / 2, w / 2) - h / 2)
+        return margin_x, margin_y
+
+    def __call__(self, sample: BboxSample):
+        W, H = sample.metadata["W"], sample.metadata["H"]
+        x0, y0, x1, y1 = sample.metadata['crop_coordinates']
+        margin_x, margin_y = self.required_margin(x1 - x0, y1 - y0)
+        margin_x = min(margin_x, x0, W - x1)
+        margin_y = min(margin_y, y0, H - y1)
+
+        sample.metadata['context_coordinates'] = (x0 - margin_x, y0 - margin_y, x1 + margin_x, y1 + margin_y)
+        sample.metadata['rotation_margin'] = (margin_x, margin_y)
+        return sample
+
 class CropImage():
+    """
+    Crops tensors, numpy and PIL images, cropping before ToTensor only converts the crop to float.
+    """
     def __call__(self,sample:BboxSample):
-        x0, y0, x1, y1 = sample.metadata['crop_coordinates']
-        sample.image = sample.image[:, y0: y1, x0: x1]
+        x0, y0, x1, y1 = sample.metadata.pop('context_coordinates', sample.metadata['crop_coordinates'])
+        if isinstance(sample.image, Image.Image):
+            sample.image = sample.image.crop((x0, y0, x1, y1))
+        elif isinstance(sample.image, np.ndarray):
+            sample.image = sample.image[y0: y1, x0: x1]
+        else:
+            sample.image = sample.image[:, y0: y1, x0: x1]
         return sample
\ No newline at end of file
@@ -28,11 +28,19 @@ class Transform(ABC):
 
 @Model2Transforms.register(name='resnet18')
 class PreapareToResnet18(Transform):
-    def __init__(self, resize_shape: tuple = (72, 72)) -> None:
+    # imagenet statistics by number of channels, the grayscale ones are the means of the RGB ones
+    normalization = {3: ([0.485, 0.456, 0.406], [0.229, 0.224, 0.225]),
+                     1: ([0.449], [0.226])}
+
+    def __init__(self, resize_shape: tuple = (72, 72), in_channels: int = 3) -> None:
         self.resize_shape = resize_shape
-        self.img_transfomrs = transforms.Compose([
-            transforms.Resize(resize_shape, antialias=False),
-            transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])])
+        self.in_channels = in_channels
+        # PIL mode the frames are loaded in
+        self.image_mode = 'L' if in_channels == 1 else 'RGB'
+        mean, std = self.normalization[in_channels]
+        self.resize = transforms.Resize(resize_shape, antialias=False)
+        self.normalize = transforms.Normalize(mean=mean, std=std)
+        self.img_transfomrs = transforms.Compose([self.resize, self.normalize])
 
     def __call__(self, sample: Union[BboxSample, torch.Tensor]):
         """
@@ -49,4 +57,4 @@ class PreapareToResnet18(Transform):
     
     def get_config(self):
         # Return a dictionary capturing the configuration of the transform
-        return {'resize_shape': self.resize_shape}
+        return {'resize_shape': self.resize_shape, 'in_channels': self.in_channels}
@@ -1,7 +1,9 @@
 # TODO Move this functions that also appear in the vmd package to a utils package
 import cv2 as cv
+import numpy as np
 import pybboxes as pbx
 from pybboxes import BoundingBox
+from collections import namedtuple
 def create_video_writer_from_capture(video_capture, output_video_path):
     frame_rate = video_capture.get(cv.CAP_PROP_FPS)
     width = int(video_capture.get(cv.CAP_PROP_FRAME_WIDTH))
@@ -20,22 +22,98 @@ def create_video_capture(input_video_path):
     assert cap.isOpened(), "Could not open video file"
     return cap
 
-def draw_video_from_bool_csv(video, df,bbox_cols_names, output_video_path,class_col_name=None,bbox_foramt='coco',frame_limit=None):
+FrameRows = namedtuple('FrameRows', ['row_ids', 'bboxes', 'columns'])
+
+class FrameBboxIndex:
+    """
+    Per frame lookup of bboxes, replaces filtering the whole DataFrame for every frame.
+    Every added chunk is sorted by frame once and a frame -> rows range table points into it,
+    so rows can arrive as a stream (e.g. pd.read_csv(..., chunksize=...)) without rebuilding the index.
+    row_ids are the positions of the rows in the order they were added.
+    """
+    def __init__(self, bbox_cols_names, frame_col_name='frame_num', extra_cols_names=()):
+        self.bbox_cols_names = list(bbox_cols_names)
+        self.frame_col_name = frame_col_name
+        self.extra_cols_names = list(extra_cols_names)
+
+        self.chunks = []
+        self.frame2ranges = {}
+        self.num_rows = 0
+
+    @classmethod
+    def from_df(cls, df, bbox_cols_names, frame_col_name='frame_num', extra_cols_names=()):
+        index = cls(bbox_cols_names, frame_col_name, extra_cols_names)
+        index.add_df(df)
+        return index
+
+    def add_df(self, df):
+        self.add(df[self.frame_col_name].values, df[self.bbox_cols_names].values,
+                 **{col_name: df[col_name].values for col_name in self.extra_cols_names})
+
+    def add(self, frame_nums, bboxes, **columns):
+        frame_nums = np.asarray(frame_nums).astype(np.int64)
+        order = np.argsort(frame_nums, kind='stable')
+        frame_nums = frame_nums[order]
+
+        chunk = {'row_ids': self.num_rows + order,
+                 'bboxes': np.asarray(bboxes).reshape(-1, 4)[order],
+                 'columns': {col_name: np.asarray(values)[order] for col_name, values in columns.items()}}
+        chunk_idx = len(self.chunks)
+        self.chunks.append(chunk)
+        self.num_rows += len(frame_nums)
+
+        frames, starts, counts = np.unique(frame_nums, return_index=True, return_counts=True)
+        for frame_num, start, count in zip(frames.tolist(), starts.tolist(), counts.tolist()):
+            self.frame2ranges.setdefault(frame_num, []).append((chunk_idx, start, start + count))
+
+    def get(self, frame_num):
+        ranges = self.frame2ranges.get(int(frame_num), [])
+        if len(ranges) == 0:
+            return FrameRows(np.zeros(0, dtype=np.int64), np.zeros((0, 4)), {col_name: np.zeros(0, dtype=object) 
+                                                                             for col_name in self.extra_cols_names})
+
+        # a frame is spread over several chunks only if its rows arrived in different chunks
+        slices = [(self.chunks[chunk_idx], slice(start, end)) for chunk_idx, start, end in ranges]
+        def gather(get_values):
+            values = [get_values(chunk)[rows] for chunk, rows in slices]
+            return values[0] if len(values) == 1 else np.concatenate(values)
+
+        return FrameRows(gather(lambda chunk: chunk['row_ids']), gather(lambda chunk: chunk['bboxes']),
+                         {col_name: gather(lambda chunk: chunk['columns'][col_name]) 
+                          for col_name in slices[0][0]['columns']})
+
+    def __contains__(self, frame_num):
+        return int(frame_num) in self.frame2ranges
+
+    def __len__(self):
+        return self.num_rows
+
+
+def draw_frame_bboxes(frame, bboxes, classes=None, bbox_foramt='coco'):
+    for i, bbox in enumerate(bboxes):
+        x, y, width, height = BoundingBox.from_coco(*pbx.convert_bbox(bbox,from_type=bbox_foramt,to_type='coco')).raw_values
+        frame = cv.rectangle(frame, (x,y), (x+width,y+height), color=(0, 255, 0), thickness=2)
+        if classes is not None:
+            cv.putText(frame, str(classes[i]), (x, y-10), cv.FONT_HERSHEY_SIMPLEX, 0.9, (36,255,12), 2)
+    return frame
+
+
+def draw_video_from_bool_csv(video, df,bbox_cols_names, output_video_path,class_col_name=None,bbox_foramt='coco',frame_limit=None,
+                             frame_col_name='frame_num'):
+    # df can be a DataFrame or an already built FrameBboxIndex
+    if isinstance(df, FrameBboxIndex):
+        bboxes_index = df
+    else:
+        extra_cols_names = [class_col_name] if class_col_name is not None else []
+        bboxes_index = FrameBboxIndex.from_df(df, bbox_cols_names, frame_col_name, extra_cols_names)
     
     writer = create_video_writer_from_capture(video, output_video_path)
     limit_flag = False
     while True:
         frame_num = video.get(cv.CAP_PROP_POS_FRAMES)
 
-        current_df = df[df["frame_num"] == frame_num]
-        current_bboxes = current_df[bbox_cols_names]
-        if class_col_name is not None:
-            current_classes = current_df[class_col_name]
-        
-        else:
-            current_classes == None
-
-
+        frame_rows = bboxes_index.get(frame_num)
+        current_classes = frame_rows.columns.get(class_col_name) if class_col_name is not None else None
 
         ret, frame = video.read()
         if frame_limit is not None:
@@ -44,14 +122,7 @@ def draw_video_from_bool_csv(video, df,bbox_cols_names, output_video_path,class_
         if not ret or limit_flag:
             break
 
-        for i, bbox in enumerate(current_bboxes.values):
-            x, y, width, height = BoundingBox.from_coco(*pbx.convert_bbox(bbox,from_type=bbox_foramt,to_type='coco')).raw_values
-            frame = cv.rectangle(frame, (x,y), (x+width,y+height), color=(0, 255, 0), thickness=2)
-            if current_classes is not None:
-                bbox_cls = current_classes.iloc[i]
-                cv.putText(frame, bbox_cls, (x, y-10), cv.FONT_HERSHEY_SIMPLEX, 0.9, (36,255,12), 2)
-
-
+        frame = draw_frame_bboxes(frame, frame_rows.bboxes, current_classes, bbox_foramt)
         writer.write(frame)
 
     video.release()
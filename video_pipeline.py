@@ -0,0 +1,192 @@
+import threading
+import queue
+import time
+import logging
+import numpy as np
+import cv2 as cv
+from ThermalClassifier.utils import FrameBboxIndex, draw_frame_bboxes, create_video_writer_from_capture
+
+_STOP = object()
+
+
+class StageStats:
+    def __init__(self, name) -> None:
+        self.name = name
+        self.busy_time = 0.0
+        self.wait_time = 0.0
+        self.items = 0
+
+    def report(self):
+        return {'items': self.items,
+                'busy_time': self.busy_time,
+                'wait_time': self.wait_time,
+                'busy_time_per_item': self.busy_time / self.items if self.items else 0.0}
+
+
+class MonitoredQueue(queue.Queue):
+    """
+    Bounded queue that samples its occupancy on every get.
+    """
+    def __init__(self, name, maxsize) -> None:
+        super().__init__(maxsize)
+        self.name = name
+        self.occupancy_sum = 0
+        self.occupancy_max = 0
+        self.gets = 0
+
+    def get(self, *args, **kwargs):
+        occupancy = self.qsize()
+        self.occupancy_sum += occupancy
+        self.occupancy_max = max(self.occupancy_max, occupancy)
+        self.gets += 1
+        return super().get(*args, **kwargs)
+
+    def report(self):
+        return {'maxsize': self.maxsize,
+                'mean_occupancy': self.occupancy_sum / self.gets if self.gets else 0.0,
+                'max_occupancy': self.occupancy_max}
+
+
+class VideoInferencePipeline:
+    """
+    Runs decode, classification and rendering concurrently on a single pass over the video:
+    a decode thread -> classification (calling thread) -> a writer thread, connected by bounded queues.
+    """
+    def __init__(self, predictor, bboxes_index: FrameBboxIndex, bbox_format='coco', frame_limit=None,
+                 queue_size=32, batch_size=None, max_latency=0.05, track_col_name=None, results_writer=None) -> None:
+        self.predictor = predictor
+        self.track_col_name = track_col_name
+        # streams the results of every frame to disk, see prediction_writers.py
+        self.results_writer = results_writer
+        get_features = results_writer is not None and results_writer.write_features
+        # crops of consecutive frames are classified together, batch_size=None classifies every frame on its own
+        self.batcher = predictor.create_batcher(batch_size, max_latency, bbox_format, get_features=get_features)
+        self.bboxes_index = bboxes_index
+        self.bbox_format = bbox_format
+        self.frame_limit = frame_limit
+        self.queue_size = queue_size
+
+        self.stop_event = threading.Event()
+        self.errors = []
+        self.stages = {name: StageStats(name) for name in ['decode', 'classify', 'write']}
+        self.queues = {name: MonitoredQueue(name, queue_size) for name in ['decoded', 'classified']}
+
+    def put(self, stage, queue_name, item):
+        # every consumer drains its queue until _STOP, even after a failure, so a blocking put is safe
+        start = time.perf_counter()
+        self.queues[queue_name].put(item)
+        self.stages[stage].wait_time += time.perf_counter() - start
+
+    def get(self, stage, queue_name):
+        start = time.perf_counter()
+        item = self.queues[queue_name].get()
+        self.stages[stage].wait_time += time.perf_counter() - start
+        return item
+
+    def decode(self, video_cap):
+        stats = self.stages['decode']
+        try:
+            while not self.stop_event.is_set():
+                start = time.perf_counter()
+                frame_num = video_cap.get(cv.CAP_PROP_POS_FRAMES)
+                success, frame = video_cap.read()
+                if not success or (self.frame_limit is not None and frame_num >= self.frame_limit):
+                    break
+                rgb_frame = cv.cvtColor(frame, cv.COLOR_BGR2RGB)
+                stats.busy_time += time.perf_counter() - start
+                stats.items += 1
+
+                self.put('decode', 'decoded', (frame_num, frame, rgb_frame))
+        except Exception as e:
+            self.errors.append(e)
+            self.stop_event.set()
+        finally:
+            self.put('decode', 'decoded', _STOP)
+
+    def write(self, video_writer):
+        stats = self.stages['write']
+        while True:
+            item = self.get('write', 'classified')
+            if item is _STOP:
+                break
+            # after a failure the queue is still drained so the classification stage never blocks
+            if video_writer is None or self.stop_event.is_set():
+                continue
+
+            start = time.perf_counter()
+            try:
+                frame, bboxes, preds = item
+                video_writer.write(draw_frame_bboxes(frame, bboxes, preds, self.bbox_format))
+            except Exception as e:
+                self.errors.append(e)
+                self.stop_event.set()
+            stats.busy_time += time.perf_counter() - start
+            stats.items += 1
+
+    def run(self, video_cap, num_rows: int, rendered_video_save_path=None):
+        """
+        Returns an array of the translated predictions per bboxes row (None for rows of unprocessed frames).
+        """
+        translated_predictions = np.full(num_rows, None, dtype=object)
+        video_writer = create_video_writer_from_capture(video_cap, rendered_video_save_path) \
+                        if rendered_video_save_path is not None else None
+
+        decode_thread = threading.Thread(target=self.decode, args=(video_cap,), daemon=True)
+        write_thread = threading.Thread(target=self.write, args=(video_writer,), daemon=True)
+        decode_thread.start()
+        write_thread.start()
+
+        stats = self.stages['classify']
+        # frames wait here until the batcher returns their results
+        pending_frames = {}
+        def forward_results(results):
+            for result in results:
+                frame, frame_rows = pending_frames.pop(result.frame_id)
+                if len(frame_rows.row_ids) > 0:
+                    translated_predictions[frame_rows.row_ids] = result.preds
+                if self.results_writer is not None:
+                    self.results_writer.write(frame_rows.row_ids, result.frame_id, result)
+                self.put('classify', 'classified', (frame, frame_rows.bboxes, result.preds))
+
+        try:
+            while True:
+                item = self.get('classify', 'decoded')
+                if item is _STOP:
+                    forward_results(self.batcher.flush())
+                    break
+                frame_num, frame, rgb_frame = item
+                logging.debug(f'frame number {frame_num} is processed')
+
+                start = time.perf_counter()
+                frame_rows = self.bboxes_index.get(frame_num)
+                pending_frames[frame_num] = (frame, frame_rows)
+                track_ids = frame_rows.columns[self.track_col_name] if self.track_col_name is not None else None
+                results = self.batcher.submit(frame_num, rgb_frame, frame_rows.bboxes, track_ids, frame_index=int(frame_num))
+                stats.busy_time += time.perf_counter() - start
+                stats.items += 1
+
+                forward_results(results)
+        except Exception as e:
+            self.errors.append(e)
+            self.stop_event.set()
+            # let the decode thread reach its _STOP
+            while self.queues['decoded'].get() is not _STOP:
+                continue
+        finally:
+            self.put('classify', 'classified', _STOP)
+            write_thread.join()
+            decode_thread.join()
+
+            video_cap.release()
+            if video_writer is not None:
+                video_writer.release()
+
+        if self.errors:
+            raise self.errors[0]
+
+        logging.info(f'pipeline report: {self.report()}')
+        return translated_predictions
+
+    def report(self):
+        return {'stages': {name: stats.report() for name, stats in self.stages.items()},
+                'queues': {name: monitored_queue.report() for name, monitored_queue in self.queues.items()}}